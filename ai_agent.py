@@ -1,177 +1,471 @@
 import os
 import logging
+import mimetypes
 import google.generativeai as genai
-from PyPDF2 import PdfReader
-import magic
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import firestore
-from docx import Document
-import openpyxl
 import time
 from google.api_core.exceptions import GoogleAPIError
-from difflib import SequenceMatcher
 import re
+import threading
+from cachetools import TTLCache
+from search_index import SearchIndex
+from vector_store import vector_store
+from text_extraction import text_extractor
+from answer_cache import answer_cache
 
 logger = logging.getLogger(__name__)
 
 class AIAgent:
+    # MIME types text extraction understands, besides anything under text/*
+    EXTRACTABLE_TYPES = [
+        'application/pdf',
+        'application/csv',
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        'application/msword',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'application/vnd.ms-excel'
+    ]
+    PASSAGE_CHARS = 1000
+    PASSAGE_OVERLAP = 200
+    MAX_BATCH_WRITES = 450  # Firestore batches are capped at 500 writes
+    CONTEXT_PASSAGES = 20  # Passages retrieved per question before packing
+    RRF_K = 60  # Reciprocal rank fusion constant; damps the lead of top-ranked results
+
     def __init__(self):
         load_dotenv()
         genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
         self.model = genai.GenerativeModel('gemini-1.5-flash') #Gemini 1.5 flash is reported to have over 1.8 billion parameters
         self.db = firestore.client()
+        self.index = SearchIndex(self.db)
+        self.context_tokens = int(os.getenv('AI_CONTEXT_TOKENS', 6000))  # Budget for file passages in a prompt
+        self.history_tokens = int(os.getenv('AI_HISTORY_TOKENS', 1500))  # Budget for earlier conversation turns
+        self._backfilling = set()
+        self._rebuilding = set()
+        self._backfill_checked = TTLCache(maxsize=10000, ttl=int(os.getenv('VECTOR_BACKFILL_RECHECK', 600)))
+        self._backfill_lock = threading.Lock()
 
-    def extract_text(self, file_path):
-        mime = magic.Magic(mime=True)
-        file_type = mime.from_file(file_path)
-        text = ""
-        try:
-            if file_type == 'application/pdf':
-                with open(file_path, 'rb') as f:
-                    pdf = PdfReader(f)
-                    for page in pdf.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-            elif file_type.startswith('text') or file_type in ['application/csv', 'text/csv']:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    text = f.read()
-            elif file_type in ['application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/msword']:
-                doc = Document(file_path)
-                for para in doc.paragraphs:
-                    text += para.text + "\n"
-            elif file_type in ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-excel']:
-                wb = openpyxl.load_workbook(file_path)
-                for sheet in wb:
-                    for row in sheet.rows:
-                        for cell in row:
-                            if cell.value:
-                                text += str(cell.value) + " "
-                        text += "\n"
-        except Exception as e:
-            logger.error(f"Text extraction failed for {file_path}: {str(e)}")
-        return text.strip()
+    @classmethod
+    def is_extractable(cls, filename):
+        file_type = mimetypes.guess_type(filename)[0] or ''
+        return file_type.startswith('text') or file_type in cls.EXTRACTABLE_TYPES
+
+    def index_in_background(self, path, file_id, filename, user_email, content_hash=None):
+        """Extract and store the content of a saved file off the request path; path is deleted afterwards."""
+        text_extractor.submit(
+            path,
+            lambda content: self._store_extracted(file_id, filename, content, user_email),
+            cleanup=True,
+            content_hash=content_hash
+        )
+
+    def _store_extracted(self, file_id, filename, content, user_email):
+        file_ref = self.db.collection('files').document(file_id)
+        if not file_ref.get().exists:
+            logger.info(f"Skipping content for {filename}: file ID {file_id} was deleted before extraction finished")
+            return
+        self.store_content(file_id, filename, content, user_email=user_email)
+        if not file_ref.get().exists:
+            # Deleted while the content was being stored
+            self.delete_content(file_id, user_email)
+
+    @classmethod
+    def split_passages(cls, text):
+        """Split text into overlapping passages of about PASSAGE_CHARS, preferring whitespace boundaries."""
+        passages = []
+        start = 0
+        while start < len(text):
+            end = min(start + cls.PASSAGE_CHARS, len(text))
+            if end < len(text):
+                boundary = text.rfind(' ', start + cls.PASSAGE_CHARS // 2, end)
+                if boundary != -1:
+                    end = boundary
+            passage = text[start:end].strip()
+            if passage:
+                passages.append({'passage': len(passages), 'start': start, 'end': end, 'text': passage})
+            if end >= len(text):
+                break
+            start = max(end - cls.PASSAGE_OVERLAP, start + 1)
+        return passages
+
+    def _passages_ref(self, file_id):
+        return self.db.collection('file_contents').document(file_id).collection('passages')
 
-    def store_content(self, file_id, filename, content):
+    def _write_passages(self, file_id, filename, passages):
+        for start in range(0, len(passages), self.MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for passage in passages[start:start + self.MAX_BATCH_WRITES]:
+                batch.set(self._passages_ref(file_id).document(str(passage['passage'])), dict(passage, file_id=file_id, filename=filename))
+            batch.commit()
+
+    def _read_passages(self, file_id, data):
+        """Passages of a stored file; content stored whole before passages existed is split on the fly."""
+        if data.get('content'):
+            return self.split_passages(data['content'])
+        return [snapshot.to_dict() for snapshot in self._passages_ref(file_id).order_by('passage').stream()]
+
+    def _delete_passages(self, file_id):
+        refs = [snapshot.reference for snapshot in self._passages_ref(file_id).select([]).stream()]
+        for start in range(0, len(refs), self.MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for ref in refs[start:start + self.MAX_BATCH_WRITES]:
+                batch.delete(ref)
+            batch.commit()
+
+    def store_content(self, file_id, filename, content, user_email=None):
+        """Store extracted text for a file as overlapping passages and index them for user_email.
+
+        Passages and index postings are written first, in bounded batches of their own; the
+        file_contents document and the index totals follow in one batch. If any write fails,
+        the passages and postings already written are removed again.
+        """
         try:
-            if not content:
+            passages = self.split_passages(content or '')
+            if not passages:
                 logger.warning(f"No content to store for file ID {file_id}: {filename}")
                 return
-            doc_ref = self.db.collection('file_contents').document(file_id)
-            doc_ref.set({
+            self._write_passages(file_id, filename, passages)
+            token_count = self.index.add(user_email, file_id, passages) if user_email else 0
+            batch = self.db.batch()
+            batch.set(self.db.collection('file_contents').document(file_id), {
                 'file_id': file_id,
                 'filename': filename,
-                'content': content,
+                'user_email': user_email,
+                'passage_count': len(passages),
+                'token_count': token_count,
+                'length': len(content),
+                'indexed': bool(user_email),
                 'timestamp': firestore.SERVER_TIMESTAMP
             })
-            logger.info(f"Stored content for file ID {file_id}: {filename}")
+            if user_email:
+                self.index.record(batch, user_email, len(passages), token_count)
+            batch.commit()
+            answer_cache.invalidate_file(file_id)
+            logger.info(f"Stored {len(passages)} passages for file ID {file_id}: {filename}")
         except Exception as e:
             logger.error(f"Failed to store content for {filename}: {str(e)}")
+            self._discard_content(file_id, user_email)
+            return
+        try:
+            if user_email:
+                vector_store.add(user_email, file_id, filename, passages)
+        except Exception as e:
+            logger.error(f"Failed to embed content for {filename}: {str(e)}")
+
+    def _discard_content(self, file_id, user_email):
+        # Drop what a failed store_content wrote before its file_contents record
+        try:
+            if user_email:
+                self.index.remove(user_email, file_id)
+            self._delete_passages(file_id)
+        except Exception as e:
+            logger.error(f"Failed to clean up partial content for file ID {file_id}: {str(e)}")
 
-    def delete_content(self, file_id):
+    def delete_content(self, file_id, user_email=None):
         try:
             doc_ref = self.db.collection('file_contents').document(file_id)
-            doc_ref.delete()
+            snapshot = doc_ref.get()
+            if not snapshot.exists:
+                return
+            data = snapshot.to_dict()
+            user_email = user_email or data.get('user_email')
+            batch = self.db.batch()
+            batch.delete(doc_ref)
+            if user_email and data.get('indexed'):
+                self.index.record(batch, user_email, -data.get('passage_count', 0), -data.get('token_count', 0))
+            batch.commit()
+            if user_email:
+                self.index.remove(user_email, file_id)
+            self._delete_passages(file_id)
+            answer_cache.invalidate_file(file_id)
+            if user_email:
+                vector_store.delete(user_email, file_id)
             logger.info(f"Deleted content for file ID {file_id}")
         except Exception as e:
             logger.error(f"Failed to delete content for file ID {file_id}: {str(e)}")
 
+    def _rebuild_index(self, user_email, file_ids):
+        """Re-index a user's stored content after the index layout changed, splitting whole-content documents into passages."""
+        self.index.clear(user_email)
+        file_ids = list(file_ids)
+        total_passages = 0
+        total_length = 0
+        for start in range(0, len(file_ids), 100):
+            refs = [self.db.collection('file_contents').document(file_id) for file_id in file_ids[start:start + 100]]
+            for snapshot in self.db.get_all(refs):
+                if not snapshot.exists:
+                    continue
+                data = snapshot.to_dict()
+                passages = self._read_passages(snapshot.id, data)
+                if not passages:
+                    continue
+                if data.get('content'):
+                    self._write_passages(snapshot.id, data['filename'], passages)
+                token_count = self.index.add(user_email, snapshot.id, passages)
+                snapshot.reference.update({
+                    'user_email': user_email,
+                    'passage_count': len(passages),
+                    'token_count': token_count,
+                    'indexed': True,
+                    'content': firestore.DELETE_FIELD
+                })
+                total_passages += len(passages)
+                total_length += token_count
+        # Totals are set outright rather than incremented, so a file stored meanwhile is never counted twice
+        self.index.mark_indexed(user_email, total_passages, total_length)
+        logger.info(f"Rebuilt search index for {user_email} ({len(file_ids)} files checked)")
+
+    def _rebuild_in_background(self, user_email, file_ids):
+        with self._backfill_lock:
+            if user_email in self._rebuilding:
+                return
+            self._rebuilding.add(user_email)
+
+        def run():
+            try:
+                self._rebuild_index(user_email, file_ids)
+            except Exception as e:
+                logger.error(f"Search index rebuild failed for {user_email}: {str(e)}")
+            finally:
+                with self._backfill_lock:
+                    self._rebuilding.discard(user_email)
+
+        threading.Thread(target=run, name='index-rebuild', daemon=True).start()
+
+    def _backfill_vectors(self, user_email, file_ids):
+        """Embed stored content this host's vector store is missing, on a background thread."""
+        with self._backfill_lock:
+            file_ids = {
+                file_id for file_id in file_ids
+                if file_id not in self._backfilling and (user_email, file_id) not in self._backfill_checked
+            }
+            self._backfilling |= file_ids
+        if not file_ids:
+            return
+
+        def run():
+            try:
+                # The other process may have embedded some of them meanwhile
+                missing = sorted(file_ids - vector_store.file_ids(user_email, refresh=True))
+                for start in range(0, len(missing), 100):
+                    refs = [self.db.collection('file_contents').document(file_id) for file_id in missing[start:start + 100]]
+                    for snapshot in self.db.get_all(refs):
+                        if snapshot.exists:
+                            data = snapshot.to_dict()
+                            vector_store.add(user_email, snapshot.id, data['filename'], self._read_passages(snapshot.id, data))
+                logger.info(f"Backfilled vector store for {user_email} ({len(missing)} files checked)")
+            except Exception as e:
+                logger.error(f"Vector backfill failed for {user_email}: {str(e)}")
+            finally:
+                with self._backfill_lock:
+                    self._backfilling -= file_ids
+                    # Files without stored content are not looked up again until the entry expires
+                    for file_id in file_ids:
+                        self._backfill_checked[(user_email, file_id)] = True
+
+        threading.Thread(target=run, name='vector-backfill', daemon=True).start()
+
+    def _vector_search(self, query, user_email, file_ids, n_results):
+        if not vector_store.available:
+            return []
+        missing = file_ids - vector_store.file_ids(user_email)
+        if missing:
+            self._backfill_vectors(user_email, missing)
+        return [
+            {
+                'file_id': passage['file_id'],
+                'filename': passage['filename'],
+                'passage': passage['passage'],
+                'start': passage['start'],
+                'end': passage['end'],
+                'content': passage['text'],
+                'relevance': passage['score']
+            }
+            for passage in vector_store.query(user_email, query, file_ids, k=n_results)
+        ]
+
+    def _fetch_passages(self, ranked):
+        """Load [(passage_id, relevance)] from file_contents, skipping passages that no longer exist."""
+        refs = []
+        for passage_id, _ in ranked:
+            file_id, passage = passage_id.rsplit(':', 1)
+            refs.append(self._passages_ref(file_id).document(passage))
+        snapshots = {snapshot.reference.path: snapshot for snapshot in self.db.get_all(refs)}
+        results = []
+        for ref, (_, relevance) in zip(refs, ranked):
+            snapshot = snapshots.get(ref.path)
+            if not snapshot or not snapshot.exists:
+                continue
+            data = snapshot.to_dict()
+            results.append({
+                'file_id': data['file_id'],
+                'filename': data['filename'],
+                'passage': data['passage'],
+                'start': data['start'],
+                'end': data['end'],
+                'content': re.sub(r'\s+', ' ', data['text']),
+                'relevance': relevance
+            })
+        return results
+
+    def _keyword_search(self, query, user_email, file_ids, stats, n_results):
+        query_words = re.split(r'\s+', query.lower().strip())
+        # Simple synonym expansion
+        synonyms = {
+            'objective': ['goal', 'aim', 'target'],
+            'milestone': ['checkpoint', 'stage', 'phase'],
+            'project': ['plan', 'initiative', 'task'],
+            'deadline': ['timeline', 'due date', 'schedule']
+        }
+        expanded_query = query_words.copy()
+        for word in query_words:
+            for key, values in synonyms.items():
+                if word == key:
+                    expanded_query.extend(values)
+                elif word in values:
+                    expanded_query.append(key)
+        terms = SearchIndex.tokenize(' '.join(expanded_query))
+        logger.debug(f"Search terms: {terms}")
+        return self._fetch_passages(self.index.search(user_email, terms, stats, file_ids, limit=n_results))
+
+    @classmethod
+    def _merge_results(cls, result_lists, n_results):
+        """Fuse ranked result lists by reciprocal rank, so scores on different scales combine."""
+        merged = {}
+        for results in result_lists:
+            for rank, result in enumerate(results):
+                entry = merged.setdefault((result['file_id'], result['passage']), dict(result, relevance=0.0))
+                entry['relevance'] += 1 / (cls.RRF_K + rank + 1)
+        return sorted(merged.values(), key=lambda r: r['relevance'], reverse=True)[:n_results]
+
     def search_content(self, query, user_email, files, n_results=10):
+        """Rank passages of files for query, fusing vector and keyword matches.
+
+        Keyword results cover files whose embeddings are still missing on this host, e.g. files
+        indexed by the other process, while they are embedded in the background.
+        """
         try:
-            file_ids = [f['id'] for f in files]
-            logger.debug(f"Searching content for user {user_email}, file IDs: {file_ids}, query: {query}")
+            file_ids = {f['id'] for f in files}
+            logger.debug(f"Searching content for user {user_email} across {len(file_ids)} files, query: {query}")
             if not file_ids:
                 logger.info(f"No file IDs provided for search by {user_email}")
                 return []
-            docs = self.db.collection('file_contents').where('file_id', 'in', file_ids).stream()
-            results = []
-            query_words = re.split(r'\s+', query.lower().strip())
-            # Simple synonym expansion
-            synonyms = {
-                'objective': ['goal', 'aim', 'target'],
-                'milestone': ['checkpoint', 'stage', 'phase'],
-                'project': ['plan', 'initiative', 'task'],
-                'deadline': ['timeline', 'due date', 'schedule']
-            }
-            expanded_query = query_words.copy()
-            for word in query_words:
-                for key, values in synonyms.items():
-                    if word == key:
-                        expanded_query.extend(values)
-                    elif word in values:
-                        expanded_query.append(key)
-            expanded_query = list(set(expanded_query))
-            logger.debug(f"Expanded query words: {expanded_query}")
-            for doc in docs:
-                data = doc.to_dict()
-                content = data.get('content', '')
-                if not content:
-                    logger.warning(f"Empty content for file ID {data.get('file_id')}: {data.get('filename')}")
-                    continue
-                # Clean content
-                content_clean = re.sub(r'\s+', ' ', content.strip())
-                content_lower = content_clean.lower()
-                # Fuzzy matching
-                similarity = SequenceMatcher(None, query.lower(), content_lower[:2000]).ratio()
-                # Word-based scoring
-                word_score = sum(content_lower.count(word) for word in expanded_query)
-                # Combined relevance
-                relevance = word_score + (similarity * 15)  # Higher weight for similarity
-                if relevance > 0.2 or any(word in content_lower for word in expanded_query):
-                    results.append({
-                        'filename': data['filename'],
-                        'content': content_clean[:3000],  # Increased to 3000 chars
-                        'relevance': relevance
-                    })
-                    logger.debug(f"Match for {data['filename']}: relevance={relevance}, similarity={similarity}, word_score={word_score}")
-            results.sort(key=lambda x: x['relevance'], reverse=True)
+            stats = self.index.stats(user_email)
+            if stats.get('version') != SearchIndex.VERSION:
+                # An older layout, or content stored before there was an index; until the rebuild
+                # finishes, keyword search answers from whatever the current layout already holds
+                self._rebuild_in_background(user_email, file_ids)
+
+            vector_results = []
+            try:
+                vector_results = self._vector_search(query, user_email, file_ids, n_results)
+            except Exception as e:
+                logger.error(f"Vector search failed for {user_email}, using keyword search only: {str(e)}")
+            keyword_results = self._keyword_search(query, user_email, file_ids, stats, n_results)
+            results = self._merge_results([vector_results, keyword_results], n_results)
             if not results:
-                logger.info(f"No content matches found for query '{query}' by {user_email}, including all files")
-                docs = self.db.collection('file_contents').where('file_id', 'in', file_ids).stream()
-                for doc in docs:
-                    data = doc.to_dict()
-                    content = data.get('content', '')
-                    if content:
-                        content_clean = re.sub(r'\s+', ' ', content.strip())
-                        results.append({
-                            'filename': data['filename'],
-                            'content': content_clean[:3000],
-                            'relevance': 0.1
-                        })
-            logger.debug(f"Returning {len(results)} content matches for query '{query}' by {user_email}")
-            return results[:n_results]
+                logger.info(f"No content matches found for query '{query}' by {user_email}, including the start of each file")
+                results = self._fetch_passages([(SearchIndex.passage_id(file_id, 0), 0.1) for file_id in sorted(file_ids)[:n_results]])
+            logger.debug(f"Returning {len(results)} passages for query '{query}' by {user_email}")
+            return results
         except Exception as e:
             logger.error(f"Content search failed for {user_email}: {str(e)}")
             return []
 
-    def answer_query(self, query, user_email, files):
-        try:
-            relevant_docs = self.search_content(query, user_email, files)
-            context = ""
-            if relevant_docs:
-                context = "\n".join(
-                    f"File: {doc['filename']}\nContent: {doc['content']}\n"
-                    for doc in relevant_docs
-                )
-            # Rephrase query for better alignment
-            rephrased_query = query
-            if any(keyword in query.lower() for keyword in ['file', 'document', 'upload', 'content']):
-                rephrased_query = f"Summarize or extract relevant information from the provided file content to answer: {query}"
-            prompt = (
-                "You are MegaCloud AI, a highly accurate assistant for a cloud storage platform. "
-                "Follow these steps to answer the user's question:\n"
-                "1. **Analyze the Question**: Determine if the question refers to uploaded files (e.g., mentions 'file,' 'document,' or specific content). "
-                "2. **Use File Content**: If file-related, answer **exclusively** using the provided file content. Quote relevant sections and synthesize information across files if needed. "
-                "3. **Handle Complex Queries**: For tasks like summarization, comparison, or inference, break down the question and address each part clearly. "
-                "4. **General Questions**: If unrelated to files, provide a precise, accurate, and professional answer using your knowledge. "
-                "5. **Format Clearly**: Use markdown (bullet points, quotes, headers) for readability.\n\n"
-                f"**User Question**: {rephrased_query}\n\n"
-                f"**File Content** (use for file-related questions):\n{context}\n\n"
-                "**Answer**:"
+    @staticmethod
+    def estimate_tokens(text):
+        # Roughly four characters per token for English text; close enough for budgeting
+        return len(text) // 4 + 1
+
+    def _pack_passages(self, relevant_docs):
+        """Pick the most relevant passages that fit the context budget, skipping ones mostly covered by a pick."""
+        picked = []
+        used = 0
+        for doc in sorted(relevant_docs, key=lambda d: d['relevance'], reverse=True):
+            overlaps = any(
+                other['file_id'] == doc['file_id']
+                and min(other['end'], doc['end']) - max(other['start'], doc['start']) > (doc['end'] - doc['start']) / 2
+                for other in picked
+            )
+            if overlaps:
+                continue
+            tokens = self.estimate_tokens(doc['content'])
+            if used + tokens > self.context_tokens:
+                continue
+            picked.append(doc)
+            used += tokens
+        # Present each file's passages together and in document order
+        first_seen = {}
+        for doc in picked:
+            first_seen.setdefault(doc['file_id'], len(first_seen))
+        return sorted(picked, key=lambda d: (first_seen[d['file_id']], d['start']))
+
+    def _pack_history(self, history):
+        """Keep the most recent turns that fit the history budget, oldest first."""
+        kept = []
+        used = 0
+        for message in reversed(history or []):
+            tokens = self.estimate_tokens(message['content'])
+            if used + tokens > self.history_tokens:
+                break
+            kept.append(message)
+            used += tokens
+        return kept[::-1]
+
+    def _build_prompt(self, query, user_email, passages, history):
+        context = ""
+        if passages:
+            context = "\n".join(
+                f"File: {doc['filename']}\nContent: {doc['content']}\n"
+                for doc in passages
             )
-            logger.debug(f"Prompt for {user_email}: {prompt[:500]}...")
+        conversation = ""
+        if history:
+            conversation = "**Conversation History**:\n" + "".join(
+                f"{'User' if message['role'] == 'user' else 'Assistant'}: {message['content']}\n"
+                for message in history
+            ) + "\n"
+        # Rephrase query for better alignment
+        rephrased_query = query
+        if any(keyword in query.lower() for keyword in ['file', 'document', 'upload', 'content', 'pdf', 'summarize']):
+            rephrased_query = f"Summarize or extract relevant information from the provided file content to answer: {query}"
+        prompt = (
+            "You are MegaCloud AI, a highly accurate assistant for a cloud storage platform. "
+            "Follow these steps to answer the user's question:\n"
+            "1. **Analyze the Question**: Determine if the question refers to uploaded files (e.g., mentions 'file,' 'document,' or specific content). "
+            "2. **Use File Content**: If file-related, answer **exclusively** using the provided file content. Quote relevant sections and synthesize information across files if needed. "
+            "3. **Handle Complex Queries**: For tasks like summarization, comparison, or inference, break down the question and address each part clearly. "
+            "4. **General Questions**: If unrelated to files, provide a precise, accurate, and professional answer using your knowledge. "
+            "5. **Format Clearly**: Use markdown (bullet points, quotes, headers) for readability.\n\n"
+            f"{conversation}"
+            f"**User Question**: {rephrased_query}\n\n"
+            f"**File Content** (use for file-related questions):\n{context}\n\n"
+            "**Answer**:"
+        )
+        logger.debug(f"Prompt for {user_email} (~{self.estimate_tokens(prompt)} tokens): {prompt[:500]}...")
+        return prompt
+
+    def answer_query_stream(self, query, user_email, files, history=None):
+        """Yield the answer to query piece by piece as Gemini generates it.
+
+        history is the earlier turns of the conversation as {'role', 'content'} dicts. Content is
+        retrieved once for the question itself and packed into the context budget. A question
+        asked again over the same passages and history is answered from the cache in a single
+        piece, without calling Gemini.
+        """
+        try:
+            passages = self._pack_passages(self.search_content(query, user_email, files, n_results=self.CONTEXT_PASSAGES))
+            history = self._pack_history(history)
+            cache_key = answer_cache.key(user_email, query, passages, history)
+            cached = answer_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"AI response for {user_email} served from cache")
+                yield cached
+                return
+            prompt = self._build_prompt(query, user_email, passages, history)
             for attempt in range(3):
+                started = False
                 try:
                     response = self.model.generate_content(
                         prompt,
@@ -180,13 +474,22 @@ class AIAgent:
                             'temperature': 0.4,  # High precision
                             'top_p': 0.9,  # Balanced creativity
                             'top_k': 40  # Diverse but focused
-                        }
+                        },
+                        stream=True
                     )
-                    answer = response.text.strip()
-                    logger.info(f"AI response for {user_email}: {answer[:100]}...")
-                    return answer
+                    pieces = []
+                    for chunk in response:
+                        if chunk.parts:
+                            started = True
+                            pieces.append(chunk.text)
+                            yield chunk.text
+                    if pieces:
+                        answer_cache.put(cache_key, "".join(pieces))
+                    logger.info(f"AI response streamed for {user_email}")
+                    return
                 except GoogleAPIError as e:
-                    if '429' in str(e) or 'Quota' in str(e).lower():
+                    # Once part of the answer has been sent, a retry would repeat it
+                    if not started and ('429' in str(e) or 'Quota' in str(e).lower()):
                         if attempt == 2:
                             logger.error(f"Gemini API quota exceeded for {user_email}: {str(e)}")
                             raise Exception("AI query failed: You have exceeded your Gemini API quota. Please check your Google Cloud billing details.")
@@ -196,4 +499,9 @@ class AIAgent:
                     raise Exception(f"AI query failed: {str(e)}")
         except Exception as e:
             logger.error(f"AI query failed for {user_email}: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+
+    def answer_query(self, query, user_email, files, history=None):
+        answer = "".join(self.answer_query_stream(query, user_email, files, history)).strip()
+        logger.info(f"AI response for {user_email}: {answer[:100]}...")
+        return answer
@@ -0,0 +1,63 @@
+import os
+import re
+import hashlib
+import logging
+import threading
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class AnswerCache:
+    """Process-wide cache of AI answers keyed by user, normalized query, the passages used and the conversation so far.
+
+    Each passage enters the key with a digest of its text, so a file re-extracted under the same
+    passage numbers no longer matches an answer built from its old content, whichever process
+    stored it. Writes to a file's content in this process also drop every answer built from it.
+    """
+
+    def __init__(self, maxsize: int = None, ttl: float = None):
+        maxsize = maxsize or int(os.getenv('ANSWER_CACHE_SIZE', 1000))
+        ttl = ttl if ttl is not None else float(os.getenv('ANSWER_CACHE_TTL', 3600))
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._keys_by_file = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return re.sub(r'\s+', ' ', query.lower()).strip().rstrip('?!. ')
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return hashlib.sha1(re.sub(r'\s+', ' ', text).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def key(cls, user_email: str, query: str, passages: list, history: list = None) -> tuple:
+        return (
+            user_email,
+            cls.normalize(query),
+            tuple(sorted((p['file_id'], p['passage'], cls.digest(p['content'])) for p in passages)),
+            tuple((m['role'], cls.normalize(m['content'])) for m in history or [])
+        )
+
+    def get(self, key: tuple):
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: tuple, answer: str):
+        with self._lock:
+            self._entries[key] = answer
+            for file_id, _, _ in key[2]:
+                self._keys_by_file.setdefault(file_id, set()).add(key)
+            if len(self._keys_by_file) > self._entries.maxsize * 2:
+                # Forget evicted and expired answers so the reverse map stays bounded
+                self._keys_by_file = {
+                    file_id: live for file_id, keys in self._keys_by_file.items()
+                    if (live := {k for k in keys if k in self._entries})
+                }
+
+    def invalidate_file(self, file_id: str):
+        with self._lock:
+            for key in self._keys_by_file.pop(file_id, ()):
+                self._entries.pop(key, None)
+
+answer_cache = AnswerCache()
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, render_template, session, send_file, redirect, url_for
+from flask import Flask, Response, request, jsonify, render_template, session, redirect, url_for, stream_with_context
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from flask_session import Session
 from flask_wtf.csrf import CSRFProtect
@@ -6,14 +6,18 @@ from auth import AuthManager
 from models import User, File, UserRepository
 from file_manager import FileManager
 from ai_agent import AIAgent
-import tempfile
+from streaming import MultipartFileStream
+from quota_cache import quota_cache
+from provider_pool import provider_pool
 import os
+import tempfile
 import json
 import mimetypes
 import logging
 import uuid
 from dotenv import load_dotenv
 import requests
+from werkzeug.datastructures import ContentRange
 from werkzeug.utils import secure_filename
 import time
 
@@ -40,9 +44,6 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'index'
 
-preview_files = {}
-download_files = {}
-
 # OAuth configuration
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
@@ -170,66 +171,59 @@ def dashboard():
 @login_required
 @csrf.exempt
 def upload():
-    if 'file' not in request.files:
-        logger.error("No file selected in upload request")
+    # The body is parsed straight off request.stream; touching request.files would spool it to disk first
+    upload_size = request.content_length
+    if not upload_size:
+        logger.error("Upload request without a Content-Length")
         return jsonify({"error": "No file selected"}), 400
-        
-    file = request.files['file']
-    if file.filename == '':
-        logger.error("Empty filename in upload request")
-        return jsonify({"error": "No file selected"}), 400
-    if file.content_length > 100 * 1024 * 1024:  # 100MB limit
-        logger.error(f"File too large: {file.filename}")
+    if upload_size > 100 * 1024 * 1024:  # 100MB limit
+        logger.error(f"Upload too large: {upload_size} bytes")
         return jsonify({"error": "File too large (max 100MB)"}), 400
 
-    temp_path = None
     try:
-        base_filename = secure_filename(file.filename)
+        file_stream = MultipartFileStream(request.stream, request.content_type, field_name='file')
+    except ValueError as e:
+        logger.error(f"Malformed upload request: {str(e)}")
+        return jsonify({"error": "No file selected"}), 400
+    if not file_stream.filename:
+        logger.error("No file selected in upload request")
+        return jsonify({"error": "No file selected"}), 400
+
+    content_file = None
+    try:
+        base_filename = secure_filename(file_stream.filename)
         unique_suffix = uuid.uuid4().hex[:8]
         storage_filename = f"{base_filename}_{unique_suffix}"  # Filename for storage providers
-        temp_path = os.path.join(tempfile.gettempdir(), storage_filename)
-        
-        # Save file in chunks
-        chunk_size = 1024 * 1024  # 1MB chunks
-        with open(temp_path, 'wb') as f:
-            while True:
-                chunk = file.stream.read(chunk_size)
-                if not chunk:
-                    break
-                f.write(chunk)
-        
-        file_size = os.path.getsize(temp_path)
-        size_mb = file_size / (1024 * 1024)
-        
-        # Extract and store file content using AIAgent
-        content = ai_agent.extract_text(temp_path)
-        if content:
-            temp_file_id = str(uuid.uuid4())
-            ai_agent.store_content(temp_file_id, base_filename, content)
-        
-        logger.info(f"Uploading file: {storage_filename} ({size_mb:.2f} MB) for {current_user.email}")
+
+        # Only documents the AI agent can read are spooled to disk for background text extraction
+        content_file = tempfile.NamedTemporaryFile(delete=False) if AIAgent.is_extractable(base_filename) else None
+
+        logger.info(f"Uploading file: {storage_filename} (up to {upload_size / (1024 * 1024):.2f} MB) for {current_user.email}")
         file_manager = FileManager(current_user)
-        chunk_ids = file_manager.upload_file(temp_path, storage_filename, current_user.email)
+        chunk_ids = file_manager.upload_stream(
+            file_stream, storage_filename, current_user.email, upload_size,
+            on_data=content_file.write if content_file else None
+        )
         if not chunk_ids:
             raise Exception("File upload to storage provider failed")
-        
+
+        file_size = sum(chunk['size'] for chunk in chunk_ids)
+        size_mb = file_size / (1024 * 1024)
+
         # Use base_filename for File object to ensure correct categorization
         file_obj = File(filename=base_filename, user_email=current_user.email, chunk_ids=chunk_ids, size_mb=size_mb)
         if not file_obj.save():
+            file_manager.discard_upload(storage_filename, chunk_ids)
             logger.error(f"Failed to save {base_filename} metadata to Firestore")
-            ai_agent.delete_content(temp_file_id)
             raise Exception("Failed to save file metadata to Firestore")
-        
-        # Update file_id in content storage
-        if content:
-            ai_agent.delete_content(temp_file_id)
-            ai_agent.store_content(file_obj.id, base_filename, content)
-        
-        user = User.get_user_by_email(current_user.email)
-        user.update_storage_used(size_mb)
-        user.save()
-        
-        logger.info(f"Uploaded {base_filename}, Size: {size_mb:.2f} MB, New Storage Used: {user.storage_used:.2f} MB")
+
+        if content_file:
+            # The content is extracted and indexed shortly after the response; the job owns the temp file
+            content_file.close()
+            ai_agent.index_in_background(content_file.name, file_obj.id, base_filename, current_user.email, file_obj.content_hash)
+            content_file = None
+
+        logger.info(f"Uploaded {base_filename}, Size: {size_mb:.2f} MB")
         
         return jsonify({
             "message": "File uploaded successfully",
@@ -241,35 +235,34 @@ def upload():
         logger.error(f"Upload failed: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
     finally:
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except Exception as cleanup_error:
-                logger.error(f"Cleanup failed for {temp_path}: {str(cleanup_error)}")
+        if content_file:
+            content_file.close()
+            os.remove(content_file.name)
 
 @app.route("/list_files", methods=["GET"])
 @login_required
 def list_files():
     try:
-        files = File.get_files(current_user.email)
+        category = request.args.get('category', 'All')
+        sort_by = request.args.get('sort', 'date')
+        limit = request.args.get('limit', File.PAGE_SIZE, type=int)
+        cursor = request.args.get('cursor') or None
+        try:
+            files, next_cursor = File.list_files(current_user.email, category=category, sort_by=sort_by, limit=limit, cursor=cursor)
+        except ValueError as e:
+            logger.warning(f"Rejected file listing for {current_user.email}: {str(e)}")
+            return jsonify({"error": str(e)}), 400
         if files is None:
             return jsonify({"error": "Failed to retrieve files"}), 500
-            
+
         for f in files:
             f['display_filename'] = '_'.join(f['filename'].split('_')[:-1])
             f['file_id'] = f['id']
-        categorized = {
-            "Images": [f for f in files if f['category'] == "Images"],
-            "Documents": [f for f in files if f['category'] == "Documents"],
-            "Videos": [f for f in files if f['category'] == "Videos"],
-            "Audio": [f for f in files if f['category'] == "Audio"],
-            "Other": [f for f in files if f['category'] == "Other"]
-        }
-        logger.info(f"Listed files for {current_user.email}: {len(files)} files found")
+        logger.info(f"Listed files for {current_user.email}: {len(files)} files in {category}")
         return jsonify({
             "success": True,
             "files": files,
-            "categorized": categorized
+            "next_cursor": next_cursor
         })
     except Exception as e:
         logger.error(f"Error listing files: {str(e)}", exc_info=True)
@@ -304,12 +297,7 @@ def stats():
         user = User.get_user_by_email(current_user.email)  # Changed from get_user to get_user_by_email
         if user is None:
             raise ValueError("User not found")
-        
-        if abs(user.storage_used - total_size) > 0.01:
-            user.storage_used = total_size
-            user.save()
-            logger.warning(f"Corrected storage_used for {current_user.email} to match total_size: {total_size} MB")
-        
+
         logger.info(f"Stats for {current_user.email}: Files: {total_files}, Total Size: {total_size} MB, Storage Used: {user.storage_used:.2f} MB")
         return jsonify({
             "success": True,
@@ -322,8 +310,49 @@ def stats():
         return jsonify({"error": f"Failed to fetch stats: {str(e)}"}), 500
 
 def get_file_by_id(file_id, user_email):
-    files = File.get_files(user_email)
-    return next((f for f in files if f['id'] == file_id), None)
+    return File.get_by_id(file_id, user_email)
+
+def stream_file_response(file, as_attachment):
+    chunks = file['chunk_ids']
+    if not chunks or not isinstance(chunks, list):
+        raise ValueError("Invalid chunk data structure")
+
+    required_fields = ['provider_id', 'chunk_number', 'chunk_path']
+    for chunk in chunks:
+        if not all(field in chunk for field in required_fields):
+            raise ValueError("Chunk data missing required fields")
+
+    base_filename = '_'.join(file['filename'].split('_')[:-1])
+    mime_type = mimetypes.guess_type(base_filename)[0] or "application/octet-stream"
+    headers = {}
+    if as_attachment:
+        headers['Content-Disposition'] = f'attachment; filename="{base_filename}"'
+
+    file_manager = FileManager(current_user)
+    total_size = file_manager.get_file_size(chunks)
+    status = 200
+    start, end = 0, None
+    if total_size is not None:
+        # Only records with a known chunk layout can serve partial content
+        headers['Accept-Ranges'] = 'bytes'
+        byte_range = None
+        if request.range and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+            byte_range = request.range.range_for_length(total_size)
+            if byte_range is None:
+                return Response(status=416, headers={'Content-Range': f"bytes */{total_size}"})
+        if byte_range:
+            start, stop = byte_range
+            end = stop - 1
+            status = 206
+            headers['Content-Range'] = ContentRange('bytes', start, stop, total_size).to_header()
+        headers['Content-Length'] = str((end + 1 if end is not None else total_size) - start)
+
+    body = file_manager.stream_file(
+        file['filename'], chunks, start, end,
+        on_manifest=lambda upgraded_chunks: File.update_manifest(file['id'], upgraded_chunks, file['user_email'])
+    )
+    logger.info(f"Streaming {file['filename']} for {current_user.email} (status {status}, MIME type {mime_type})")
+    return Response(stream_with_context(body), status=status, mimetype=mime_type, headers=headers)
 
 @app.route("/download/<file_id>", methods=["GET"])
 @login_required
@@ -333,63 +362,16 @@ def download(file_id):
         if not file:
             logger.error(f"File with ID {file_id} not found for {current_user.email}")
             return jsonify({"error": "File not found"}), 404
-            
-        temp_dir = tempfile.gettempdir()
-        output_path = os.path.join(temp_dir, file['filename'])
-        
-        chunks = file['chunk_ids']
-        if not chunks or not isinstance(chunks, list):
-            raise ValueError("Invalid chunk data structure")
-            
-        required_fields = ['provider_id', 'chunk_number', 'chunk_path']
-        for chunk in chunks:
-            if not all(field in chunk for field in required_fields):
-                raise ValueError("Chunk data missing required fields")
-        
-        file_manager = FileManager(current_user)
-        file_manager.download_file(file['filename'], chunks, output_path, current_user.email)
-        
-        if not os.path.exists(output_path):
-            raise FileNotFoundError("File reconstruction failed")
-            
-        base_filename = '_'.join(file['filename'].split('_')[:-1])
-        mime_type = mimetypes.guess_type(base_filename)[0] or "application/octet-stream"
-        
-        download_files[base_filename] = output_path
-        logger.info(f"Downloaded {file['filename']} for {current_user.email}")
-        
-        return send_file(
-            output_path,
-            as_attachment=True,
-            mimetype=mime_type,
-            download_name=base_filename
-        )
-        
+        return stream_file_response(file, as_attachment=True)
     except Exception as e:
         logger.error(f"Download failed for file ID {file_id}: {str(e)}", exc_info=True)
-        if 'output_path' in locals() and os.path.exists(output_path):
-            try:
-                os.remove(output_path)
-                logger.info(f"Cleaned up {output_path} in exception handler")
-            except Exception as cleanup_error:
-                logger.error(f"Cleanup failed in exception block: {str(cleanup_error)}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/cleanup_download/<filename>", methods=["POST"])
 @login_required
 def cleanup_download(filename):
-    try:
-        if filename in download_files:
-            output_path = download_files.pop(filename)
-            if os.path.exists(output_path):
-                os.remove(output_path)
-                logger.info(f"Cleaned up download file: {output_path}")
-            return jsonify({"success": True, "message": "Download file cleaned up"}), 200
-        logger.warning(f"File {filename} not found in download cache")
-        return jsonify({"error": "File not found in download cache"}), 404
-    except Exception as e:
-        logger.error(f"Cleanup failed for {filename}: {str(e)}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+    # Downloads are streamed from the providers, so there is no local copy left to clean up
+    return jsonify({"success": True, "message": "Download file cleaned up"}), 200
 
 @app.route("/preview/<file_id>", methods=["GET"])
 @login_required
@@ -399,37 +381,7 @@ def preview(file_id):
         if not file:
             logger.error(f"File with ID {file_id} not found for {current_user.email}")
             return jsonify({"error": "File not found"}), 404
-            
-        os.makedirs("downloads", exist_ok=True)
-        output_path = os.path.join("downloads", file['filename'])
-        
-        chunks = file['chunk_ids']
-        if not chunks or not isinstance(chunks, list):
-            raise ValueError("Invalid chunk data structure")
-            
-        required_fields = ['provider_id', 'chunk_number', 'chunk_path']
-        for chunk in chunks:
-            if not all(field in chunk for field in required_fields):
-                raise ValueError("Chunk data missing required fields")
-        
-        file_manager = FileManager(current_user)
-        file_manager.download_file(file['filename'], chunks, output_path, current_user.email)
-        
-        if not os.path.exists(output_path):
-            raise FileNotFoundError("File reconstruction failed")
-            
-        base_filename = '_'.join(file['filename'].split('_')[:-1])
-        mime_type = mimetypes.guess_type(base_filename)[0] or "application/octet-stream"
-        
-        preview_files[base_filename] = output_path
-        logger.info(f"Previewing {file['filename']} for {current_user.email} with MIME type {mime_type}")
-        
-        return send_file(
-            output_path,
-            as_attachment=False,
-            mimetype=mime_type
-        )
-        
+        return stream_file_response(file, as_attachment=False)
     except Exception as e:
         logger.error(f"Preview failed for file ID {file_id}: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
@@ -437,18 +389,8 @@ def preview(file_id):
 @app.route("/cleanup_preview/<filename>", methods=["POST"])
 @login_required
 def cleanup_preview(filename):
-    try:
-        if filename in preview_files:
-            output_path = preview_files.pop(filename)
-            if os.path.exists(output_path):
-                os.remove(output_path)
-                logger.info(f"Cleaned up preview file: {output_path}")
-            return jsonify({"success": True, "message": "Preview file cleaned up"}), 200
-        logger.warning(f"File {filename} not found in preview cache")
-        return jsonify({"error": "File not found in preview cache"}), 404
-    except Exception as e:
-        logger.error(f"Cleanup failed for {filename}: {str(e)}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+    # Previews are streamed from the providers, so there is no local copy left to clean up
+    return jsonify({"success": True, "message": "Preview file cleaned up"}), 200
 
 @app.route("/delete/<file_id>", methods=["DELETE"])
 @login_required
@@ -460,19 +402,16 @@ def delete(file_id):
             return jsonify({"error": "File not found"}), 404
             
         file_manager = FileManager(current_user)
-        success = file_manager.delete_file(file['filename'], file['chunk_ids'], current_user.email)
+        success = file_manager.delete_file(file['filename'], file['chunk_ids'], current_user.email, file['id'])
         
         if not success:
             logger.error(f"Failed to delete all chunks for {file['filename']} from storage providers")
             return jsonify({"error": "Failed to delete file from all providers"}), 500
         
-        user = User.get_user_by_email(current_user.email)  # Changed from get_user to get_user_by_email
-        user.update_storage_used(-file['size_mb'])
-        user.save()
-        logger.info(f"Deleted {file['filename']} from providers, New Storage Used: {user.storage_used:.2f} MB")
-        
-        File.delete_file(file['id'])
-        ai_agent.delete_content(file['id'])
+        logger.info(f"Deleted {file['filename']} from providers")
+
+        File.delete_file(file['id'], current_user.email, file['size_mb'])
+        ai_agent.delete_content(file['id'], current_user.email)
         logger.info(f"Deleted {file['filename']} from Firestore and Firestore content")
         return jsonify({"success": True, "message": "File deleted"}), 200
         
@@ -562,6 +501,8 @@ def manage_storage_accounts():
         user.storage_accounts = [acc for acc in user.storage_accounts if acc['id'] != account_id]
         if not user.save():
             return jsonify({"error": "Failed to delete storage account"}), 500
+        provider_pool.evict(account_id)
+        quota_cache.invalidate(account_id)
             
         return jsonify({"success": True, "message": "Storage account deleted"})
 
@@ -599,6 +540,7 @@ def google_oauth_callback():
         }
         account['status'] = 'connected'
         account['is_active'] = True
+        quota_cache.invalidate(account['id'])
         
         user.update_storage_quota()
         if not user.save():
@@ -654,6 +596,7 @@ def dropbox_oauth_callback():
         }
         account['status'] = 'connected'
         account['is_active'] = True
+        quota_cache.invalidate(account['id'])
         
         user.update_storage_quota()
         if not user.save():
@@ -687,6 +630,24 @@ def ai_ask():
         if files is None:
             files = []
         
+        if request.args.get('stream') or request.accept_mimetypes.best == 'text/event-stream':
+            # Server-sent events: one "data" event per piece of the answer, then "done" (or "error")
+            user_email = current_user.email
+
+            def events():
+                try:
+                    for delta in ai_agent.answer_query_stream(query, user_email, files):
+                        yield f"data: {json.dumps({'delta': delta})}\n\n"
+                    yield "event: done\ndata: {}\n\n"
+                except Exception as e:
+                    yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+            return Response(
+                stream_with_context(events()),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
         # Use AIAgent to process query
         answer = ai_agent.answer_query(query, current_user.email, files)
         
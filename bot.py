@@ -1733,6 +1733,7 @@
 
 
 import os
+import asyncio
 import logging
 import uuid
 import tempfile
@@ -1764,7 +1765,11 @@ from werkzeug.utils import secure_filename
 from firebase_admin import firestore
 from models import User, File, UserRepository
 from file_manager import FileManager
+from provider_pool import provider_pool
+from quota_cache import quota_cache
 from ai_agent import AIAgent
+from text_extraction import text_extractor
+from extraction_cache import extraction_cache
 import mimetypes
 import aiohttp
 from PIL import Image
@@ -1813,6 +1818,9 @@ ai_agent = AIAgent()
 RATE_LIMIT = 30  # Max commands per minute
 USER_REQUESTS = {}  # Track requests per user
 SESSION_CACHE = TTLCache(maxsize=1000, ttl=86400)  # 24-hour session cache
+FILES_PER_PAGE = 5  # Files shown per page in category listings
+AI_EDIT_INTERVAL = 1.0  # Seconds between edits of a streaming AI answer; Telegram throttles faster edits
+MESSAGE_LIMIT = 4096  # Telegram's maximum message length
 
 
 def rate_limit_exceeded(user_id: str) -> bool:
@@ -1931,14 +1939,14 @@ def build_file_actions(file_id: str):
     return InlineKeyboardMarkup(keyboard)
 
 
-def build_pagination_buttons(page: int, total_pages: int, category: str):
+def build_pagination_buttons(page: int, has_next: bool, category: str):
     keyboard = []
     row = []
     if page > 1:
         row.append(
             InlineKeyboardButton("⬅️ Prev", callback_data=f"page_{category}_{page-1}")
         )
-    if page < total_pages:
+    if has_next:
         row.append(
             InlineKeyboardButton("Next ➡️", callback_data=f"page_{category}_{page+1}")
         )
@@ -1961,6 +1969,31 @@ async def send_notification(telegram_id: str, message: str):
             logger.error(f"Failed to send notification to {telegram_id}: {str(e)}")
 
 
+async def stream_ai_answer(
+    message, query: str, user_email: str, files: list, history: list = None
+) -> str:
+    """Stream an AI answer into message, editing it as pieces arrive; returns the full answer."""
+    loop = asyncio.get_running_loop()
+    stream = ai_agent.answer_query_stream(query, user_email, files, history)
+    answer = ""
+    last_edit = loop.time()
+    while True:
+        # The Gemini stream is blocking, so each piece is awaited on a worker thread
+        delta = await loop.run_in_executor(None, next, stream, None)
+        if delta is None:
+            break
+        answer += delta
+        if loop.time() - last_edit >= AI_EDIT_INTERVAL:
+            # Partial markdown may not parse, so intermediate edits are plain text
+            text = f"🤖 AI Response\n{answer} ▌"
+            try:
+                await message.edit_text(text[-MESSAGE_LIMIT:])
+            except telegram_error.BadRequest as e:
+                logger.debug(f"Skipped AI answer edit: {str(e)}")
+            last_edit = loop.time()
+    return answer.strip()
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     if rate_limit_exceeded(user_id):
@@ -2541,16 +2574,10 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             file_size = os.path.getsize(temp_path)
             size_mb = file_size / (1024 * 1024)
 
-            content = ai_agent.extract_text(temp_path)
-            temp_file_id = str(uuid.uuid4())
-            if content:
-                ai_agent.store_content(temp_file_id, base_filename, content)
-
             chunk_ids = file_manager.upload_file(
                 temp_path, storage_filename, user.email
             )
             if not chunk_ids:
-                ai_agent.delete_content(temp_file_id)
                 raise Exception("File upload to storage provider failed")
 
             file_obj = File(
@@ -2560,15 +2587,20 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 size_mb=size_mb,
             )
             if not file_obj.save():
-                ai_agent.delete_content(temp_file_id)
+                file_manager.discard_upload(storage_filename, chunk_ids)
                 raise Exception("Failed to save file metadata")
 
-            if content:
-                ai_agent.delete_content(temp_file_id)
-                ai_agent.store_content(file_obj.id, base_filename, content)
+            if AIAgent.is_extractable(base_filename):
+                # Indexed in the background; the extraction job deletes the temp file when done
+                ai_agent.index_in_background(
+                    temp_path,
+                    file_obj.id,
+                    base_filename,
+                    user.email,
+                    file_obj.content_hash,
+                )
+                temp_path = None
 
-            user.update_storage_used(size_mb)
-            user.save()
             uploaded_files.append((file_obj.id, base_filename, size_mb))
 
             await send_notification(
@@ -2584,7 +2616,7 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="Markdown",
             )
         finally:
-            if os.path.exists(temp_path):
+            if temp_path and os.path.exists(temp_path):
                 try:
                     os.remove(temp_path)
                 except Exception as e:
@@ -2620,8 +2652,23 @@ async def list_files_by_category(
         return
 
     user = User.get_user_by_email(session["email"])
-    files = File.get_files(user.email)
-    if files is None:
+
+    # Firestore cursors for the pages of the current listing, so each page is one bounded query
+    listing = f"{category}:{sort_by}"
+    page_cursors = session.get("page_cursors", {})
+    if page_cursors.get("listing") != listing:
+        page_cursors = {"listing": listing, "pages": {}}
+    if page > 1 and str(page) not in page_cursors["pages"]:
+        page = 1
+
+    paginated_files, next_cursor = File.list_files(
+        user.email,
+        category=category,
+        sort_by=sort_by,
+        limit=FILES_PER_PAGE,
+        cursor=page_cursors["pages"].get(str(page)),
+    )
+    if paginated_files is None:
         await query.message.reply_text(
             "⚠️ *Failed to retrieve files.*",
             parse_mode="Markdown",
@@ -2629,10 +2676,7 @@ async def list_files_by_category(
         )
         return
 
-    if category != "All":
-        files = [f for f in files if f["category"] == category]
-
-    if not files:
+    if not paginated_files:
         await query.message.reply_text(
             f"📂 *No {category.lower()} files found.*",
             parse_mode="Markdown",
@@ -2640,22 +2684,10 @@ async def list_files_by_category(
         )
         return
 
-    # Sorting
-    if sort_by == "date":
-        files.sort(key=lambda x: x.get("created_at", 0), reverse=True)
-    elif sort_by == "size":
-        files.sort(key=lambda x: x["size_mb"], reverse=True)
-    else:
-        files.sort(key=lambda x: "_".join(x["filename"].split("_")[:-1]).lower())
-
+    if next_cursor:
+        page_cursors["pages"][str(page + 1)] = next_cursor
+    session["page_cursors"] = page_cursors
     session["sort_by"] = sort_by
-    save_user_session(user_id, session)
-
-    files_per_page = 5
-    total_pages = (len(files) + files_per_page - 1) // files_per_page
-    start_idx = (page - 1) * files_per_page
-    end_idx = start_idx + files_per_page
-    paginated_files = files[start_idx:end_idx]
 
     file_map = session.get("file_map", {})
     for f in paginated_files:
@@ -2664,11 +2696,11 @@ async def list_files_by_category(
     session["file_map"] = file_map
     save_user_session(user_id, session)
 
-    message = f"📂 *{category} Files (Page {page}/{total_pages})*\n\n"
+    message = f"📂 *{category} Files (Page {page})*\n\n"
     for f in paginated_files:
         message += f"📄 *{f['display_filename']}* ({f['size_mb']:.2f} MB)\nCategory: {f['category']}\n\n"
 
-    pagination_buttons = build_pagination_buttons(page, total_pages, category)
+    pagination_buttons = build_pagination_buttons(page, bool(next_cursor), category)
     keyboard = pagination_buttons + [
         [InlineKeyboardButton("🔙 Categories", callback_data="list_files")],
         [InlineKeyboardButton("🏠 Home", callback_data="main_menu")],
@@ -3099,6 +3131,8 @@ async def delete_storage_account(query, context, account_id):
             "⚠️ *Failed to delete storage account.*", parse_mode="Markdown"
         )
         return
+    provider_pool.evict(account_id)
+    quota_cache.invalidate(account_id)
 
     await query.message.reply_text(
         f"✅ *{account['provider_type'].replace('_', ' ').title()} account deleted.*",
@@ -3124,25 +3158,44 @@ async def preview_file(query, context, file_id):
         return
 
     user = User.get_user_by_email(session["email"])
-    file = next((f for f in File.get_files(user.email) if f["id"] == file_id), None)
+    file = File.get_by_id(file_id, user.email)
     if not file:
         await query.message.reply_text("⚠️ *File not found.*", parse_mode="Markdown")
         return
 
+    base_filename = "_".join(file["filename"].split("_")[:-1])
+    mime_type = mimetypes.guess_type(base_filename)[0] or "application/octet-stream"
+    if mime_type in ["application/pdf", "text/plain"]:
+        # Text already extracted from these bytes is previewed without downloading the file
+        snippet = extraction_cache.snippet(file.get("content_hash"))
+        if snippet is not None:
+            snippet = snippet + "..." if len(snippet) >= 200 else snippet
+            await query.message.reply_text(
+                f"📄 *{base_filename}*\n\n*Preview:*\n{snippet}", parse_mode="Markdown"
+            )
+            logger.info(f"Previewed {file['filename']} for {user.email} from cache")
+            await query.message.reply_text(
+                "✅ *Preview complete.*\nWhat’s next?",
+                parse_mode="Markdown",
+                reply_markup=build_file_actions(file_id),
+            )
+            return
+
     await query.message.reply_text("⏳ *Preparing preview…*", parse_mode="Markdown")
     temp_dir = tempfile.gettempdir()
     output_path = os.path.join(temp_dir, file["filename"])
     try:
         file_manager = FileManager(user)
         file_manager.download_file(
-            file["filename"], file["chunk_ids"], output_path, user.email
+            file["filename"],
+            file["chunk_ids"],
+            output_path,
+            user.email,
+            on_manifest=lambda chunk_ids: File.update_manifest(file["id"], chunk_ids, user.email),
         )
         if not os.path.exists(output_path):
             raise FileNotFoundError("File reconstruction failed")
 
-        base_filename = "_".join(file["filename"].split("_")[:-1])
-        mime_type = mimetypes.guess_type(base_filename)[0] or "application/octet-stream"
-
         if mime_type.startswith("image/"):
             img = Image.open(output_path)
             img.thumbnail((200, 200))
@@ -3163,7 +3216,9 @@ async def preview_file(query, context, file_id):
                     audio=f, caption=f"🎵 *{base_filename}*", parse_mode="Markdown"
                 )
         elif mime_type in ["application/pdf", "text/plain"]:
-            content = ai_agent.extract_text(output_path)
+            content = await asyncio.get_running_loop().run_in_executor(
+                None, text_extractor.extract, output_path, file.get("content_hash")
+            )
             snippet = content[:200] + "..." if len(content) > 200 else content
             await query.message.reply_text(
                 f"📄 *{base_filename}*\n\n*Preview:*\n{snippet}", parse_mode="Markdown"
@@ -3205,7 +3260,7 @@ async def download_file(query, context, file_id):
         return
 
     user = User.get_user_by_email(session["email"])
-    file = next((f for f in File.get_files(user.email) if f["id"] == file_id), None)
+    file = File.get_by_id(file_id, user.email)
     if not file:
         await query.message.reply_text("⚠️ *File not found.*", parse_mode="Markdown")
         return
@@ -3216,7 +3271,11 @@ async def download_file(query, context, file_id):
     try:
         file_manager = FileManager(user)
         file_manager.download_file(
-            file["filename"], file["chunk_ids"], output_path, user.email
+            file["filename"],
+            file["chunk_ids"],
+            output_path,
+            user.email,
+            on_manifest=lambda chunk_ids: File.update_manifest(file["id"], chunk_ids, user.email),
         )
         if not os.path.exists(output_path):
             raise FileNotFoundError("File reconstruction failed")
@@ -3258,23 +3317,21 @@ async def delete_file(query, context, file_id):
         return
 
     user = User.get_user_by_email(session ["email"])
-    file = next((f for f in File.get_files(user.email) if f["id"] == file_id), None)
+    file = File.get_by_id(file_id, user.email)
     if not file:
         await query.message.reply_text("⚠️ *File not found.*", parse_mode="Markdown")
         return
 
     file_manager = FileManager(user)
-    success = file_manager.delete_file(file["filename"], file["chunk_ids"], user.email)
+    success = file_manager.delete_file(file["filename"], file["chunk_ids"], user.email, file_id)
     if not success:
         await query.message.reply_text(
             "⚠️ *Failed to delete file.*", parse_mode="Markdown"
         )
         return
 
-    user.update_storage_used(-file["size_mb"])
-    user.save()
-    File.delete_file(file_id)
-    ai_agent.delete_content(file_id)
+    File.delete_file(file_id, user.email, file["size_mb"])
+    ai_agent.delete_content(file_id, user.email)
     filename = session.get("file_map", {}).get(file_id, "Unknown")
     await query.message.reply_text(
         f"✅ *File {filename} deleted.*",
@@ -3331,70 +3388,40 @@ async def ai_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = User.get_user_by_email(session["email"])
     files = File.get_files(user.email) or []
     try:
-        # Retrieve AI context from session
-        ai_context = session.get("ai_context", [])
-        ai_context.append({"role": "user", "content": query})
-        ai_context = ai_context[-10:]  # Limit to last 10 messages
-
-        # Fetch relevant file content
-        relevant_docs = ai_agent.search_content(query, user.email, files, n_results=5)
-        context_str = ""
-        if relevant_docs:
-            context_str = "\n".join(
-                f"File: {doc['filename']}\nContent: {doc['content']}\n"
-                for doc in relevant_docs
-            )
-        else:
-            context_str = "No relevant file content found."
-
-        # Build prompt with conversation history and file content
-        conversation_history = "Conversation history:\n"
-        for msg in ai_context:
-            role = "User" if msg["role"] == "user" else "Assistant"
-            conversation_history += f"{role}: {msg['content']}\n"
-
-        # Rephrase query for file-related questions
-        rephrased_query = query
-        if any(keyword in query.lower() for keyword in ['file', 'document', 'upload', 'content', 'pdf', 'summarize']):
-            rephrased_query = f"Summarize or extract relevant information from the provided file content to answer: {query}"
-
-        prompt = (
-            "You are MegaCloud AI, a highly accurate assistant for a cloud storage platform. "
-            "Follow these steps to answer the user's question:\n"
-            "1. **Analyze the Question**: Determine if the question refers to uploaded files (e.g., mentions 'file,' 'document,' or specific content). "
-            "2. **Use File Content**: If file-related, answer **exclusively** using the provided file content. Quote relevant sections and synthesize information across files if needed. "
-            "3. **Handle Complex Queries**: For tasks like summarization, comparison, or inference, break down the question and address each part clearly. "
-            "4. **General Questions**: If unrelated to files, provide a precise, accurate, and professional answer using your knowledge. "
-            "5. **Format Clearly**: Use markdown (bullet points, quotes, headers) for readability.\n\n"
-            f"**Conversation History**:\n{conversation_history}\n"
-            f"**User Question**: {rephrased_query}\n\n"
-            f"**File Content** (use for file-related questions):\n{context_str}\n\n"
-            "**Answer**:"
-        )
-
-        # Generate response using AIAgent
+        # Earlier turns of this chat; the agent retrieves file content for the question itself
+        history = session.get("ai_context", [])[-10:]
+        ai_context = history + [{"role": "user", "content": query}]
+
+        # Generate response using AIAgent, streamed into a single message
+        message = await update.message.reply_text("🤖 AI Response\n▌")
         for attempt in range(3):
             try:
-                answer = ai_agent.answer_query(prompt, user.email, files)
-                if not answer or "unknown" in answer.lower():
-                    answer = "No specific information found in uploaded files. Please clarify or ask a different question."
-                ai_context.append({"role": "assistant", "content": answer})
-                session["ai_context"] = ai_context
-                save_user_session(user_id, session)
-                await update.message.reply_text(
-                    f"🤖 *AI Response*\n{answer}\n\nAsk another question or stop:",
-                    parse_mode="Markdown",
-                    reply_markup=ReplyKeyboardMarkup(
-                        [["Stop AI Chat"], ["Clear AI History"]], one_time_keyboard=True
-                    ),
-                )
-                logger.info(f"AI query answered for {user.email}: {query}")
-                return AI_QUERY
+                answer = await stream_ai_answer(message, query, user.email, files, history)
+                break
             except Exception as e:
                 logger.error(f"AI query attempt {attempt+1} failed: {str(e)}")
                 if attempt == 2:
                     raise
                 await asyncio.sleep(2 ** attempt)
+        if not answer or "unknown" in answer.lower():
+            answer = "No specific information found in uploaded files. Please clarify or ask a different question."
+        ai_context.append({"role": "assistant", "content": answer})
+        session["ai_context"] = ai_context[-10:]
+        save_user_session(user_id, session)
+        final_text = f"🤖 *AI Response*\n{answer}"
+        try:
+            await message.edit_text(final_text[:MESSAGE_LIMIT], parse_mode="Markdown")
+        except telegram_error.BadRequest:
+            # The model's markdown does not always parse as Telegram Markdown
+            await message.edit_text(f"🤖 AI Response\n{answer}"[:MESSAGE_LIMIT])
+        await update.message.reply_text(
+            "Ask another question or stop:",
+            reply_markup=ReplyKeyboardMarkup(
+                [["Stop AI Chat"], ["Clear AI History"]], one_time_keyboard=True
+            ),
+        )
+        logger.info(f"AI query answered for {user.email}: {query}")
+        return AI_QUERY
 
     except Exception as e:
         logger.error(f"AI query failed: {str(e)}", exc_info=True)
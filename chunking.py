@@ -0,0 +1,70 @@
+import os
+import hashlib
+import numpy as np
+
+class ContentChunker:
+    """Content-defined chunking with a gear rolling hash.
+
+    Cut points depend only on the bytes just before them, so inserting or removing data in one
+    place only changes the chunks around the edit; the rest of the file still splits into the
+    same chunks (and the same sha256s) as the copy that is already stored.
+    """
+    WINDOW = 32  # A 32-bit gear hash only depends on the last 32 bytes
+    SCAN_BLOCK = 1024 * 1024  # Bytes hashed per numpy pass while looking for a cut point
+    # Derived from sha256 rather than a RNG so cut points never change between deployments
+    GEAR = np.array(
+        [int.from_bytes(hashlib.sha256(bytes([value])).digest()[:4], 'big') for value in range(256)],
+        dtype=np.uint32
+    )
+
+    def __init__(self, avg_size: int = None, min_size: int = None, max_size: int = None):
+        self.avg_size = avg_size or int(os.getenv('CDC_AVG_CHUNK_MB', 4)) * 1024 * 1024
+        self.min_size = min_size or self.avg_size // 4
+        self.max_size = max_size or self.avg_size * 4
+        # Test the high bits, which depend on the whole window, for a cut roughly every avg_size bytes
+        bits = max(1, (self.avg_size - self.min_size).bit_length() - 1)
+        self.mask = np.uint32(((1 << bits) - 1) << (32 - bits))
+
+    def _hashes(self, data, start: int, end: int) -> np.ndarray:
+        """Gear hash at each position in [start, end): sum of GEAR[byte i-k] << k over the window, mod 2**32."""
+        first = max(0, start - self.WINDOW + 1)
+        values = self.GEAR[np.frombuffer(data, dtype=np.uint8, count=end - first, offset=first)]
+        hashes = np.zeros(end - start, dtype=np.uint32)
+        for shift in range(self.WINDOW):
+            begin = max(start, first + shift)
+            if begin >= end:
+                break
+            hashes[begin - start:] += values[begin - shift - first:end - shift - first] << np.uint32(shift)
+        return hashes
+
+    def cut_point(self, data) -> int:
+        """Length of the first chunk of data; data must hold max_size bytes unless it is the end of the input."""
+        length = len(data)
+        if length <= self.min_size:
+            return length
+        end = min(length, self.max_size)
+        position = self.min_size
+        while position < end:
+            block_end = min(position + self.SCAN_BLOCK, end)
+            hits = np.flatnonzero((self._hashes(data, position, block_end) & self.mask) == 0)
+            if hits.size:
+                return position + int(hits[0]) + 1
+            position = block_end
+        return end
+
+    def chunks(self, stream):
+        """Yield the content-defined chunks of a readable stream, holding at most max_size bytes ahead."""
+        buffer = bytearray()
+        eof = False
+        while True:
+            while not eof and len(buffer) < self.max_size:
+                data = stream.read(self.max_size - len(buffer))
+                if data:
+                    buffer.extend(data)
+                else:
+                    eof = True
+            if not buffer:
+                return
+            cut = self.cut_point(buffer)
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
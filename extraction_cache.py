@@ -0,0 +1,70 @@
+import os
+import logging
+import threading
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+class ExtractionCache:
+    """Extracted text and preview snippets keyed by the content hash of a file's bytes.
+
+    Full texts are kept in a process-wide LRU bounded by total characters; snippets are also
+    persisted in Firestore (extracted_text/{hash}) so a preview never needs the file itself,
+    even after a restart or from the other process.
+    """
+    SNIPPET_CHARS = 500
+
+    def __init__(self, max_chars: int = None, max_snippets: int = None):
+        max_chars = max_chars or int(os.getenv('EXTRACTION_CACHE_MB', 64)) * 1024 * 1024
+        self._texts = LRUCache(maxsize=max_chars, getsizeof=lambda text: max(len(text), 1))
+        self._snippets = LRUCache(maxsize=max_snippets or int(os.getenv('SNIPPET_CACHE_SIZE', 5000)))
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _collection(self):
+        if self._db is None:
+            from firebase_admin import firestore
+            self._db = firestore.client()
+        return self._db.collection('extracted_text')
+
+    def get_text(self, content_hash: str):
+        if not content_hash:
+            return None
+        with self._lock:
+            return self._texts.get(content_hash)
+
+    def put(self, content_hash: str, text: str):
+        """Remember the text extracted from content_hash; an empty text records that there is nothing to show."""
+        if not content_hash:
+            return
+        snippet = text[:self.SNIPPET_CHARS]
+        with self._lock:
+            if len(text) <= self._texts.maxsize:
+                self._texts[content_hash] = text
+            self._snippets[content_hash] = snippet
+        try:
+            self._collection().document(content_hash).set({'snippet': snippet, 'length': len(text)})
+        except Exception as e:
+            logger.error(f"Failed to persist snippet for {content_hash}: {str(e)}")
+
+    def snippet(self, content_hash: str, length: int = 200):
+        """Return the first length characters of the text extracted from content_hash, or None if unknown."""
+        if not content_hash:
+            return None
+        with self._lock:
+            text = self._texts.get(content_hash)
+            snippet = text[:self.SNIPPET_CHARS] if text is not None else self._snippets.get(content_hash)
+        if snippet is None:
+            try:
+                doc = self._collection().document(content_hash).get()
+            except Exception as e:
+                logger.error(f"Failed to read snippet for {content_hash}: {str(e)}")
+                return None
+            if not doc.exists:
+                return None
+            snippet = doc.to_dict().get('snippet', '')
+            with self._lock:
+                self._snippets[content_hash] = snippet
+        return snippet[:length]
+
+extraction_cache = ExtractionCache()
@@ -0,0 +1,84 @@
+import os
+import copy
+import logging
+import threading
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class FileCache:
+    """Process-wide cache of each user's file records, keyed by user email.
+
+    File writes update the cached list in place, so within a process listings reflect writes
+    immediately. Every File save and delete also increments files_version on the owner's user
+    document, and a listing is only served while that counter still matches the one it was read
+    at, so writes from another process (web app vs. bot, other gunicorn workers) invalidate it.
+    """
+
+    def __init__(self, maxsize: int = None, ttl: float = None):
+        maxsize = maxsize or int(os.getenv('FILE_CACHE_SIZE', 1000))
+        ttl = ttl if ttl is not None else float(os.getenv('FILE_CACHE_TTL', 300))
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._versions = {}  # Bumped on every write so a slow read cannot overwrite a newer write-through
+        self._files_versions = {}  # Firestore files_version each cached listing reflects
+        self._lock = threading.Lock()
+
+    def version(self, user_email: str) -> int:
+        with self._lock:
+            return self._versions.get(user_email, 0)
+
+    def get(self, user_email: str, files_version: int):
+        """Return a copy of the user's cached file records, or None if they are not cached at files_version."""
+        with self._lock:
+            files = self._entries.get(user_email)
+            if files is None or self._files_versions.get(user_email) != files_version:
+                return None
+            return copy.deepcopy(files)
+
+    def set(self, user_email: str, files: list, version: int, files_version: int):
+        """Cache a full listing read when the user's records were at the given local and Firestore versions."""
+        with self._lock:
+            if self._versions.get(user_email, 0) == version:
+                self._entries[user_email] = copy.deepcopy(files)
+                self._files_versions[user_email] = files_version
+
+    def put_file(self, user_email: str, data: dict):
+        """Write through a saved record; the save incremented the owner's files_version by one."""
+        with self._lock:
+            self._versions[user_email] = self._versions.get(user_email, 0) + 1
+            if user_email in self._files_versions:
+                self._files_versions[user_email] += 1
+            files = self._entries.get(user_email)
+            if files is not None:
+                files[:] = [f for f in files if f['id'] != data['id']] + [copy.deepcopy(data)]
+
+    def update_file(self, file_id: str, changes: dict, user_email: str = None):
+        with self._lock:
+            for email in self._owners(file_id, user_email):
+                self._versions[email] = self._versions.get(email, 0) + 1
+                for f in self._entries.get(email) or []:
+                    if f['id'] == file_id:
+                        f.update(copy.deepcopy(changes))
+
+    def remove_file(self, file_id: str, user_email: str = None):
+        """Drop a deleted record; a delete made with the owner's email also incremented their files_version."""
+        with self._lock:
+            for email in self._owners(file_id, user_email):
+                self._versions[email] = self._versions.get(email, 0) + 1
+                if user_email and email in self._files_versions:
+                    self._files_versions[email] += 1
+                files = self._entries.get(email)
+                if files is not None:
+                    files[:] = [f for f in files if f['id'] != file_id]
+
+    def _owners(self, file_id: str, user_email: str = None) -> list:
+        if user_email:
+            return [user_email]
+        return [email for email, files in self._entries.items() if any(f['id'] == file_id for f in files)]
+
+    def invalidate(self, user_email: str):
+        with self._lock:
+            self._versions[user_email] = self._versions.get(user_email, 0) + 1
+            self._entries.pop(user_email, None)
+
+file_cache = FileCache()
@@ -1,228 +1,453 @@
+import io
 import os
 import uuid
+import hashlib
 import logging
-import shutil
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Optional
 from googleapiclient.errors import HttpError
-from storage_providers.google_drive import GoogleDriveProvider
-from storage_providers.dropbox import DropboxProvider
+from quota_cache import quota_cache
+from provider_pool import provider_pool
+from chunking import ContentChunker
+from models import ChunkIndex
 
 logger = logging.getLogger(__name__)
 
 class FileManager:
-    DROPBOX_MAX_CHUNK_MB = 50  # Dropbox max chunk size in MB
+    MAX_UPLOAD_WORKERS = int(os.getenv('MAX_UPLOAD_WORKERS', 5))
+    MAX_DOWNLOAD_WORKERS = int(os.getenv('MAX_DOWNLOAD_WORKERS', 5))
+    PROVIDER_CONCURRENCY = {'GoogleDriveProvider': 2, 'DropboxProvider': 2}  # Concurrent requests per storage account
+    COPY_BUFFER_SIZE = 1024 * 1024  # 1MB copy buffer
+    STREAM_CHUNK_MB = int(os.getenv('STREAM_CHUNK_MB', 16))  # Largest chunk held in memory while streaming
 
     def __init__(self, user):
         self.user = user
+        self.provider_accounts = {}  # id(provider) -> storage account id, for the quota cache
+        # Chunk boundaries must not depend on the upload path, or identical content would not deduplicate
+        self.chunker = ContentChunker(max_size=self.STREAM_CHUNK_MB * 1024 * 1024)
         self.storage_providers = self._initialize_providers()
 
     def _initialize_providers(self) -> Dict[str, List]:
         providers = {'google_drive': [], 'dropbox': []}
-        self.user.refresh_credentials()  # Ensure tokens are valid
-        for account in self.user.get_active_storage_accounts():
+        accounts = self.user.get_active_storage_accounts()
+        folder_ids = {account['id']: account.get('folder_id') for account in accounts}
+        for account in accounts:
             try:
-                if account['provider_type'] == 'google_drive':
-                    provider = GoogleDriveProvider(
-                        account['credentials'], 
-                        f"MegaCloud/{self.user.email}", 
-                        self.user.email
-                    )
-                    providers['google_drive'].append(provider)
-                elif account['provider_type'] == 'dropbox':
-                    provider = DropboxProvider(
-                        account['credentials'], 
-                        f"/MegaCloud/{self.user.email}"
-                    )
-                    providers['dropbox'].append(provider)
+                provider = provider_pool.get(account, self.user.email)
+                providers[account['provider_type']].append(provider)
+                self.provider_accounts[id(provider)] = account['id']
             except Exception as e:
                 logger.error(f"Failed to initialize {account['provider_type']} provider for {account['email']}: {str(e)}")
+        if any(account.get('folder_id') != folder_ids[account['id']] for account in accounts):
+            self.user.save()  # Persist newly resolved Drive folder ids
         logger.info(f"Initialized FileManager with {len(providers['google_drive'])} Google Drive and {len(providers['dropbox'])} Dropbox providers")
         return providers
 
-    def _split_file(self, file_path: str, chunk_size: int) -> List[str]:
-        chunk_paths = []
-        file_size = os.path.getsize(file_path)
-        with open(file_path, 'rb') as f:
-            for i in range(0, file_size, chunk_size):
-                chunk_path = os.path.join(tempfile.gettempdir(), f"chunk_{uuid.uuid4().hex[:8]}")
-                chunk_data = f.read(chunk_size)
-                with open(chunk_path, 'wb') as chunk_file:
-                    chunk_file.write(chunk_data)
-                chunk_paths.append(chunk_path)
-        return chunk_paths
+    def _get_quota(self, provider) -> dict:
+        return quota_cache.get(self.provider_accounts[id(provider)], provider.get_storage_quota)
+
+    def _placement(self, provider_storage: List, file_size: int) -> List[List]:
+        total_free_mb = sum(free_mb for _, free_mb in provider_storage)
+        # [provider, bytes left of its proportional share, bytes of free space left]
+        return [
+            [provider, file_size * free_mb / total_free_mb, free_mb * 1024 * 1024]
+            for provider, free_mb in provider_storage
+        ]
+
+    def _place_chunk(self, placement: List[List], length: int):
+        # Chunk sizes are decided by content, so each one goes to the account furthest behind its share
+        candidates = [entry for entry in placement if entry[2] >= length]
+        if not candidates:
+            raise ValueError(f"Insufficient storage for a {length / (1024 * 1024)} MB chunk")
+        entry = max(candidates, key=lambda entry: entry[1])
+        entry[1] -= length
+        entry[2] -= length
+        return entry[0]
+
+    def _provider_storage(self, size: int) -> List:
+        size_mb = size / (1024 * 1024)
+        active_providers = self.storage_providers['google_drive'] + self.storage_providers['dropbox']
+        if not active_providers:
+            raise ValueError("No active storage providers available")
+
+        provider_storage = [(p, self._get_quota(p).get('free_mb', 0.0)) for p in active_providers]
+        provider_storage = [(p, free_mb) for p, free_mb in provider_storage if free_mb > 0]
+        total_free_mb = sum(free_mb for _, free_mb in provider_storage)
+        if total_free_mb < size_mb:
+            raise ValueError(f"Insufficient total storage: {total_free_mb} MB available, {size_mb} MB needed")
+        return provider_storage
+
+    def _provider_semaphores(self, providers) -> Dict[int, threading.BoundedSemaphore]:
+        return {
+            id(provider): threading.BoundedSemaphore(self.PROVIDER_CONCURRENCY.get(provider.__class__.__name__, 1))
+            for provider in providers
+        }
+
+    def _upload_chunk(self, data: bytes, task: Dict, base_name: str, ext: str, semaphores: Dict, buffer_slots: threading.BoundedSemaphore):
+        """Store one chunk, reusing an identical chunk already stored for this user.
+
+        Returns the chunk record and whether new bytes were written to the provider.
+        """
+        provider = task['provider']
+        chunk_number = task['chunk_number']
+        try:
+            digest = hashlib.sha256(data).hexdigest()
+            placement = {
+                'chunk_number': str(chunk_number),
+                'offset': task['offset'],
+                'size': task['length'],
+                'sha256': digest
+            }
+            existing = ChunkIndex.acquire(self.user.email, digest)
+            if existing and existing['account_id'] in self.provider_accounts.values():
+                logger.info(f"Chunk {chunk_number} ({task['length']} bytes) is already stored as {existing['chunk_path']}, reusing it")
+                return dict(existing, **placement, indexed=True), False
+            indexed = existing is None
+            if existing:
+                # The stored copy lives on an account that is no longer connected, so keep an unshared copy
+                ChunkIndex.release(self.user.email, digest)
+
+            unique_filename = f"{base_name}_part{chunk_number}_{uuid.uuid4().hex[:8]}{ext}"
+            with semaphores[id(provider)]:
+                chunk_path_uploaded = provider.upload_fileobj(io.BytesIO(data), unique_filename)
+            logger.info(f"Uploaded chunk {chunk_number} ({task['length']} bytes) to {provider.__class__.__name__} as {unique_filename}")
+            chunk_info = {
+                'provider_id': provider.__class__.__name__,
+                'chunk_path': chunk_path_uploaded,
+                'account_email': self.user.email,
+                'account_id': self.provider_accounts[id(provider)],
+                **placement,
+                'indexed': indexed
+            }
+            if indexed:
+                winner = ChunkIndex.register(self.user.email, chunk_info)
+                if winner:
+                    # A concurrent upload stored the same content first; share its copy and drop ours
+                    provider.delete(chunk_path_uploaded)
+                    return dict(winner, **placement, indexed=True), False
+            return chunk_info, True
+        finally:
+            buffer_slots.release()
 
-    def upload_file(self, file_path: str, filename: str, user_email: str) -> Optional[List[Dict[str, str]]]:
+    def _release_chunk(self, chunk_info: Dict, provider, file_id: Optional[str] = None) -> bool:
+        """Drop a File's reference to a chunk and delete the stored copy once nothing references it.
+
+        Returns True if the copy was deleted.
+        """
+        if chunk_info.get('indexed') and not ChunkIndex.release(self.user.email, chunk_info['sha256'], file_id, chunk_info['chunk_path']):
+            return False
+        provider.delete(chunk_info['chunk_path'])
+        if 'size' in chunk_info:
+            quota_cache.credit(self.provider_accounts[id(provider)], int(chunk_info['size']) / (1024 * 1024))
+        return True
+
+    def _rollback_chunks(self, filename: str, uploaded: Dict[int, Dict]) -> None:
+        provider_map = self._provider_map()
+        for chunk_info in uploaded.values():
+            try:
+                self._release_chunk(chunk_info, self._lookup_provider(chunk_info, provider_map))
+            except Exception as e:
+                logger.error(f"Failed to roll back chunk {chunk_info['chunk_path']} of {filename}: {str(e)}")
+
+    def discard_upload(self, filename: str, chunk_ids: List[Dict]) -> None:
+        """Undo an upload whose File record could not be saved: drop its chunk references and delete unshared copies."""
+        self._rollback_chunks(filename, dict(enumerate(chunk_ids)))
+
+    def upload_stream(self, stream, filename: str, user_email: str, size_hint: int, on_data=None) -> Optional[List[Dict[str, str]]]:
+        """Split a readable stream into content-defined chunks and upload them without touching local disk.
+
+        Chunks already stored for this user are referenced instead of uploaded again. size_hint
+        only needs to be an upper bound (e.g. the request Content-Length). on_data, if given,
+        sees every chunk buffer in order.
+        """
         try:
-            file_size = os.path.getsize(file_path)
-            file_size_mb = file_size / (1024 * 1024)
-            temp_dir = tempfile.gettempdir()
-            disk_usage = shutil.disk_usage(temp_dir)
-            free_space = disk_usage.free
-            
-            if free_space < file_size * 2:
-                raise OSError(f"Not enough disk space in {temp_dir}. Required: {file_size * 2} bytes, Available: {free_space} bytes")
-
-            active_providers = self.storage_providers['google_drive'] + self.storage_providers['dropbox']
-            if not active_providers:
-                raise ValueError("No active storage providers available")
-
-            provider_storage = [(p, p.get_storage_quota().get('free_mb', 0.0)) for p in active_providers if p.get_storage_quota().get('free_mb', 0.0) > 0]
-            total_free_mb = sum(free_mb for _, free_mb in provider_storage)
-            if total_free_mb < file_size_mb:
-                raise ValueError(f"Insufficient total storage: {total_free_mb} MB available, {file_size_mb} MB needed")
-
-            chunk_ids = []
-            chunk_number = 1
-            remaining_size_mb = file_size_mb
+            if not size_hint:
+                raise ValueError("Upload size is unknown")
+            provider_storage = self._provider_storage(size_hint)
+            placement = self._placement(provider_storage, size_hint)
 
             # Preserve original extension for chunk naming
             base_name, ext = os.path.splitext(filename)
-            
-            with open(file_path, 'rb') as f:
-                for provider, free_mb in provider_storage:
-                    if remaining_size_mb <= 0:
-                        break
-
-                    proportion = free_mb / total_free_mb
-                    chunk_size_mb = min(remaining_size_mb, file_size_mb * proportion)
-                    chunk_size_bytes = int(chunk_size_mb * 1024 * 1024)
-
-                    if provider.__class__.__name__ == 'DropboxProvider' and chunk_size_mb > self.DROPBOX_MAX_CHUNK_MB:
-                        chunk_size_mb = self.DROPBOX_MAX_CHUNK_MB
-                        chunk_size_bytes = int(chunk_size_mb * 1024 * 1024)
-
-                    chunk_path = os.path.join(tempfile.gettempdir(), f"chunk_{uuid.uuid4().hex[:8]}")
-                    chunk_data = f.read(chunk_size_bytes)
-                    if not chunk_data:
-                        break
-
-                    with open(chunk_path, 'wb') as chunk_file:
-                        chunk_file.write(chunk_data)
-
-                    actual_chunk_size_mb = os.path.getsize(chunk_path) / (1024 * 1024)
-
-                    if provider.__class__.__name__ == 'DropboxProvider' and actual_chunk_size_mb > self.DROPBOX_MAX_CHUNK_MB:
-                        sub_chunks = self._split_file(chunk_path, int(self.DROPBOX_MAX_CHUNK_MB * 1024 * 1024))
-                        for sub_chunk_path in sub_chunks:
-                            unique_filename = f"{base_name}_part{chunk_number}_{uuid.uuid4().hex[:8]}{ext}"
-                            chunk_path_uploaded = provider.upload(sub_chunk_path, unique_filename)
-                            chunk_ids.append({
-                                'provider_id': provider.__class__.__name__,
-                                'chunk_number': str(chunk_number),
-                                'chunk_path': chunk_path_uploaded,
-                                'account_email': self.user.email
-                            })
-                            logger.info(f"Uploaded sub-chunk {sub_chunk_path} to Dropbox as {unique_filename}")
-                            os.remove(sub_chunk_path)
-                            if provider.__class__.__name__ == 'DropboxProvider':
-                                self.user.refresh_credentials()  # Update stored token
-                            chunk_number += 1
-                        os.remove(chunk_path)
-                    else:
-                        unique_filename = f"{base_name}_part{chunk_number}_{uuid.uuid4().hex[:8]}{ext}"
-                        chunk_path_uploaded = provider.upload(chunk_path, unique_filename)
-                        chunk_ids.append({
-                            'provider_id': provider.__class__.__name__,
-                            'chunk_number': str(chunk_number),
-                            'chunk_path': chunk_path_uploaded,
-                            'account_email': self.user.email
-                        })
-                        logger.info(f"Uploaded {chunk_path} to {provider.__class__.__name__} as {unique_filename}")
-                        os.remove(chunk_path)
-                        if provider.__class__.__name__ == 'DropboxProvider':
-                            self.user.refresh_credentials()  # Update stored token
-                        chunk_number += 1
-
-                    remaining_size_mb -= actual_chunk_size_mb
-
-            total_uploaded_mb = file_size_mb - remaining_size_mb
-            if abs(file_size_mb - total_uploaded_mb) > 0.001:
-                raise ValueError(f"Failed to upload entire file: {file_size_mb - total_uploaded_mb} MB not uploaded")
-
-            return chunk_ids
+
+            semaphores = self._provider_semaphores(provider for provider, _ in provider_storage)
+            # Each in-flight chunk holds one buffer, so this caps memory at MAX_UPLOAD_WORKERS * STREAM_CHUNK_MB
+            buffer_slots = threading.BoundedSemaphore(self.MAX_UPLOAD_WORKERS)
+            uploaded = {}
+            stored = set()
+            futures = {}
+            offset = 0
+            with ThreadPoolExecutor(max_workers=self.MAX_UPLOAD_WORKERS) as executor:
+                try:
+                    chunks = self.chunker.chunks(stream)
+                    while True:
+                        failed = next((f for f in futures if f.done() and f.exception()), None)
+                        if failed:
+                            failed.result()
+
+                        buffer_slots.acquire()
+                        data = next(chunks, None)
+                        if data is None:
+                            buffer_slots.release()
+                            break
+                        if offset + len(data) > size_hint:
+                            buffer_slots.release()
+                            raise ValueError(f"Upload of {filename} is larger than the expected {size_hint} bytes")
+                        task = {
+                            'provider': self._place_chunk(placement, len(data)),
+                            'chunk_number': len(futures) + 1,
+                            'offset': offset,
+                            'length': len(data)
+                        }
+                        offset += len(data)
+                        if on_data:
+                            on_data(data)
+                        futures[executor.submit(self._upload_chunk, data, task, base_name, ext, semaphores, buffer_slots)] = task
+                        del data
+
+                    if not futures:
+                        raise ValueError(f"Upload of {filename} is empty")
+
+                    for future in as_completed(futures):
+                        chunk_info, is_new = future.result()
+                        uploaded[futures[future]['chunk_number']] = chunk_info
+                        if is_new:
+                            stored.add(futures[future]['chunk_number'])
+                except Exception:
+                    for pending in futures:
+                        pending.cancel()
+                    for future, task in futures.items():
+                        if not future.cancelled() and future.exception() is None:
+                            uploaded[task['chunk_number']] = future.result()[0]
+                    self._rollback_chunks(filename, uploaded)
+                    raise
+
+            tasks = sorted(futures.values(), key=lambda task: task['chunk_number'])
+            for task in tasks:
+                if task['chunk_number'] in stored:
+                    quota_cache.debit(self.provider_accounts[id(task['provider'])], task['length'] / (1024 * 1024))
+
+            logger.info(f"Uploaded {filename} as {len(tasks)} chunks ({len(tasks) - len(stored)} already stored) across {len(provider_storage)} providers")
+            return [uploaded[task['chunk_number']] for task in tasks]
 
         except Exception as e:
             logger.error(f"Upload failed for {filename}: {str(e)}")
             return None
-        finally:
-            for temp_file in os.listdir(tempfile.gettempdir()):
-                if temp_file.startswith('chunk_'):
-                    try:
-                        os.remove(os.path.join(tempfile.gettempdir(), temp_file))
-                    except Exception as e:
-                        logger.error(f"Failed to clean up temp file {temp_file}: {str(e)}")
 
-    def download_file(self, filename: str, chunk_ids: List[Dict[str, str]], output_path: str, user_email: str) -> None:
+    def upload_file(self, file_path: str, filename: str, user_email: str) -> Optional[List[Dict[str, str]]]:
         try:
-            if not chunk_ids or not isinstance(chunk_ids, list):
-                raise ValueError("Invalid chunk_ids provided")
-
-            sorted_chunks = sorted(chunk_ids, key=lambda x: int(x.get('chunk_number', '0')))
-            temp_chunk_paths = []
+            file_size = os.path.getsize(file_path)
+            with open(file_path, 'rb') as f:
+                return self.upload_stream(f, filename, user_email, file_size)
+        except Exception as e:
+            logger.error(f"Upload failed for {filename}: {str(e)}")
+            return None
 
-            provider_map = {}
-            for provider_type, provider_list in self.storage_providers.items():
-                for provider in provider_list:
-                    email = self.user.email
-                    provider_map[(provider.__class__.__name__, email)] = provider
+    def _provider_map(self) -> Dict:
+        provider_map = {}
+        for provider_type, provider_list in self.storage_providers.items():
+            for provider in provider_list:
+                email = self.user.email
+                provider_map[(provider.__class__.__name__, email)] = provider
+                provider_map[self.provider_accounts[id(provider)]] = provider
+        return provider_map
+
+    def _lookup_provider(self, chunk_info: Dict, provider_map: Dict):
+        # Chunks recorded before account ids were stored can only be matched by provider type
+        if chunk_info.get('account_id'):
+            return provider_map.get(chunk_info['account_id'])
+        return provider_map.get((chunk_info.get('provider_id'), chunk_info.get('account_email')))
+
+    def _resolve_chunk_provider(self, chunk_info: Dict, provider_map: Dict):
+        provider_type = chunk_info.get('provider_id')
+        account_email = chunk_info.get('account_email')
+        if not provider_type or not chunk_info.get('chunk_path') or not chunk_info.get('chunk_number'):
+            raise ValueError(f"Chunk data missing required fields: {chunk_info}")
+
+        provider = self._lookup_provider(chunk_info, provider_map)
+        if not provider:
+            raise ValueError(f"No matching provider found for {provider_type} with email {account_email}")
+        return provider
+
+    def _hash_range(self, path: str, offset: int, length: int) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(self.COPY_BUFFER_SIZE, length))
+                if not data:
+                    break
+                digest.update(data)
+                length -= len(data)
+        return digest.hexdigest()
+
+    def _download_chunk(self, filename: str, chunk_info: Dict, provider, semaphores: Dict, output_path: str, offset: int = 0) -> bool:
+        chunk_path = chunk_info['chunk_path']
+        try:
+            with semaphores[id(provider)]:
+                with open(output_path, 'r+b') as outfile:
+                    provider.download_fileobj(chunk_path, outfile, offset)
+            if chunk_info.get('sha256') and self._hash_range(output_path, offset, int(chunk_info['size'])) != chunk_info['sha256']:
+                raise ValueError(f"Checksum mismatch for chunk {chunk_info['chunk_number']} of {filename}")
+            logger.info(f"Downloaded chunk {chunk_info['chunk_number']} for {filename} from {chunk_info['provider_id']} to {output_path}@{offset}")
+            return True
+        except HttpError as e:
+            if e.resp.status == 404:
+                logger.warning(f"Chunk {chunk_path} not found on {chunk_info['provider_id']}, skipping...")
+                return False
+            raise
 
-            for chunk_info in sorted_chunks:
-                provider_type = chunk_info.get('provider_id')
-                chunk_path = chunk_info.get('chunk_path')
-                chunk_num = chunk_info.get('chunk_number')
-                account_email = chunk_info.get('account_email')
+    def download_file(self, filename: str, chunk_ids: List[Dict[str, str]], output_path: str, user_email: str, on_manifest=None) -> None:
+        """Rebuild a file at output_path.
 
-                if not provider_type or not chunk_path or not chunk_num:
-                    raise ValueError(f"Chunk data missing required fields: {chunk_info}")
+        For legacy records without a chunk layout, on_manifest (if given) receives chunk_ids upgraded
+        with the offset, size and sha256 observed while downloading, so the caller can persist them.
+        """
+        temp_chunk_paths = {}
+        try:
+            if not chunk_ids or not isinstance(chunk_ids, list):
+                raise ValueError("Invalid chunk_ids provided")
 
-                provider = provider_map.get((provider_type, account_email))
-                if not provider:
-                    raise ValueError(f"No matching provider found for {provider_type} with email {account_email}")
+            sorted_chunks = sorted(chunk_ids, key=lambda x: int(x.get('chunk_number', '0')))
 
-                temp_chunk_path = os.path.join(tempfile.gettempdir(), f"download_chunk_{chunk_num}_{uuid.uuid4().hex[:8]}")
-                try:
-                    provider.download(chunk_path, temp_chunk_path)
-                    temp_chunk_paths.append(temp_chunk_path)
-                    logger.info(f"Downloaded chunk {chunk_num} for {filename} from {provider_type} to {temp_chunk_path}")
-                    if provider.__class__.__name__ == 'DropboxProvider':
-                        self.user.refresh_credentials()  # Update stored token
-                except HttpError as e:
-                    if e.resp.status == 404:
-                        logger.warning(f"Chunk {chunk_path} not found on {provider_type}, skipping...")
-                        continue
-                    raise
+            provider_map = self._provider_map()
 
-            if not temp_chunk_paths:
-                raise ValueError("No chunks were successfully downloaded")
+            chunk_providers = [self._resolve_chunk_provider(chunk_info, provider_map) for chunk_info in sorted_chunks]
+            semaphores = self._provider_semaphores(chunk_providers)
+            # Chunks uploaded with their byte layout are written straight to their offset in the output file
+            has_layout = all('offset' in chunk_info and 'size' in chunk_info for chunk_info in sorted_chunks)
 
             with open(output_path, 'wb') as outfile:
-                for temp_chunk_path in sorted(temp_chunk_paths, key=lambda x: int(x.split('_chunk_')[1].split('_')[0])):
-                    with open(temp_chunk_path, 'rb') as infile:
-                        outfile.write(infile.read())
+                if has_layout:
+                    outfile.truncate(sum(int(chunk_info['size']) for chunk_info in sorted_chunks))
+            downloaded = 0
+
+            with ThreadPoolExecutor(max_workers=min(self.MAX_DOWNLOAD_WORKERS, len(sorted_chunks))) as executor:
+                if has_layout:
+                    futures = [
+                        executor.submit(self._download_chunk, filename, chunk_info, provider, semaphores, output_path, int(chunk_info['offset']))
+                        for chunk_info, provider in zip(sorted_chunks, chunk_providers)
+                    ]
+                    # Every chunk's range is preallocated, so a skipped one would leave zeros in the file
+                    missing = [chunk_info['chunk_number'] for chunk_info, future in zip(sorted_chunks, futures) if not future.result()]
+                    if missing:
+                        raise ValueError(f"Chunks {', '.join(missing)} of {filename} are missing from their providers")
+                    downloaded = len(futures)
+                else:
+                    futures = []
+                    for chunk_info, provider in zip(sorted_chunks, chunk_providers):
+                        temp_chunk_path = os.path.join(tempfile.gettempdir(), f"download_chunk_{chunk_info['chunk_number']}_{uuid.uuid4().hex[:8]}")
+                        open(temp_chunk_path, 'wb').close()
+                        temp_chunk_paths[chunk_info['chunk_number']] = temp_chunk_path
+                        futures.append(executor.submit(self._download_chunk, filename, chunk_info, provider, semaphores, temp_chunk_path))
+
+                    # Legacy chunks have no recorded sizes, so they are appended in order as soon as each one lands
+                    upgraded_chunks = []
+                    offset = 0
+                    with open(output_path, 'ab') as outfile:
+                        for chunk_info, future in zip(sorted_chunks, futures):
+                            if not future.result():
+                                continue
+                            temp_chunk_path = temp_chunk_paths.pop(chunk_info['chunk_number'])
+                            digest = hashlib.sha256()
+                            size = 0
+                            with open(temp_chunk_path, 'rb') as infile:
+                                for data in iter(lambda: infile.read(self.COPY_BUFFER_SIZE), b''):
+                                    outfile.write(data)
+                                    digest.update(data)
+                                    size += len(data)
+                            os.remove(temp_chunk_path)
+                            upgraded_chunks.append(dict(chunk_info, offset=offset, size=size, sha256=digest.hexdigest()))
+                            offset += size
+                            downloaded += 1
+
+                    if on_manifest and len(upgraded_chunks) == len(sorted_chunks):
+                        on_manifest(upgraded_chunks)
+
+            if not downloaded:
+                raise ValueError("No chunks were successfully downloaded")
             logger.info(f"Reconstructed {filename} to {output_path}")
 
         except Exception as e:
             logger.error(f"Download failed for {filename}: {str(e)}")
             raise
         finally:
-            for temp_chunk_path in temp_chunk_paths:
+            for temp_chunk_path in temp_chunk_paths.values():
                 if os.path.exists(temp_chunk_path):
                     try:
                         os.remove(temp_chunk_path)
                     except Exception as e:
                         logger.error(f"Failed to clean up temp chunk {temp_chunk_path}: {str(e)}")
 
-    def delete_file(self, filename: str, chunk_ids: List[Dict[str, str]], user_email: str) -> bool:
+    def get_file_size(self, chunk_ids: List[Dict[str, str]]) -> Optional[int]:
+        """Total size in bytes, or None for legacy records whose chunk layout was never recorded."""
+        if not chunk_ids or not all('offset' in chunk_info and 'size' in chunk_info for chunk_info in chunk_ids):
+            return None
+        return sum(int(chunk_info['size']) for chunk_info in chunk_ids)
+
+    def stream_file(self, filename: str, chunk_ids: List[Dict[str, str]], start: int = 0, end: Optional[int] = None, on_manifest=None):
+        """Return a generator of the file's bytes from start to end (inclusive), fetched chunk by chunk in order.
+
+        Only the chunks overlapping the range are requested from the providers. Chunks and providers
+        are validated here, before the generator is returned, so errors surface before any byte is sent.
+        Legacy records are streamed whole, and on_manifest receives their upgraded chunk_ids once the
+        last byte has been sent.
+        """
+        if not chunk_ids or not isinstance(chunk_ids, list):
+            raise ValueError("Invalid chunk_ids provided")
+
+        sorted_chunks = sorted(chunk_ids, key=lambda x: int(x.get('chunk_number', '0')))
+        provider_map = self._provider_map()
+        segments = []
+        if self.get_file_size(chunk_ids) is None:
+            if start or end is not None:
+                raise ValueError(f"Byte ranges are not available for {filename}")
+            for chunk_info in sorted_chunks:
+                segments.append((chunk_info, self._resolve_chunk_provider(chunk_info, provider_map), 0, None))
+        else:
+            for chunk_info in sorted_chunks:
+                chunk_start = int(chunk_info['offset'])
+                chunk_end = chunk_start + int(chunk_info['size']) - 1
+                if chunk_end < start or (end is not None and chunk_start > end):
+                    continue
+                segments.append((
+                    chunk_info,
+                    self._resolve_chunk_provider(chunk_info, provider_map),
+                    max(start, chunk_start) - chunk_start,
+                    (min(end, chunk_end) if end is not None else chunk_end) - chunk_start
+                ))
+
+        legacy = self.get_file_size(chunk_ids) is None
+
+        def generate():
+            upgraded_chunks = []
+            offset = 0
+            for chunk_info, provider, range_start, range_end in segments:
+                digest = hashlib.sha256()
+                size = 0
+                for data in provider.iter_range(chunk_info['chunk_path'], range_start, range_end):
+                    if legacy:
+                        digest.update(data)
+                        size += len(data)
+                    yield data
+                if legacy:
+                    upgraded_chunks.append(dict(chunk_info, offset=offset, size=size, sha256=digest.hexdigest()))
+                    offset += size
+                logger.info(f"Streamed chunk {chunk_info['chunk_number']} of {filename} from {chunk_info['provider_id']}")
+            if legacy and on_manifest:
+                on_manifest(upgraded_chunks)
+
+        logger.info(f"Streaming {filename}: {len(segments)} of {len(sorted_chunks)} chunks, bytes {start}-{'' if end is None else end}")
+        return generate()
+
+    def delete_file(self, filename: str, chunk_ids: List[Dict[str, str]], user_email: str, file_id: Optional[str] = None) -> bool:
+        """Release a File's chunks; safe to retry with the same file_id after a partial failure."""
         try:
             if not chunk_ids or not isinstance(chunk_ids, list):
                 raise ValueError("Invalid chunk_ids provided")
 
-            provider_map = {}
-            for provider_type, provider_list in self.storage_providers.items():
-                for provider in provider_list:
-                    email = self.user.email
-                    provider_map[(provider.__class__.__name__, email)] = provider
+            provider_map = self._provider_map()
 
             all_deleted = True
             for chunk_info in chunk_ids:
@@ -233,17 +458,17 @@ class FileManager:
                 if not provider_type or not chunk_path:
                     raise ValueError(f"Chunk data missing required fields: {chunk_info}")
 
-                provider = provider_map.get((provider_type, account_email))
+                provider = self._lookup_provider(chunk_info, provider_map)
                 if not provider:
                     logger.warning(f"No matching provider found for {provider_type} with email {account_email}, skipping chunk deletion")
                     all_deleted = False
                     continue
 
                 try:
-                    provider.delete(chunk_path)
-                    logger.info(f"Deleted chunk {chunk_path} for {filename} from {provider_type}")
-                    if provider.__class__.__name__ == 'DropboxProvider':
-                        self.user.refresh_credentials()  # Update stored token
+                    if self._release_chunk(chunk_info, provider, file_id):
+                        logger.info(f"Deleted chunk {chunk_path} for {filename} from {provider_type}")
+                    else:
+                        logger.info(f"Kept chunk {chunk_path} of {filename}, other files still reference it")
                 except HttpError as e:
                     if e.resp.status == 404:
                         logger.warning(f"Chunk {chunk_path} already deleted or not found on {provider_type}, continuing...")
@@ -262,7 +487,7 @@ class FileManager:
         try:
             for provider_list in self.storage_providers.values():
                 for provider in provider_list:
-                    quota = provider.get_storage_quota()
+                    quota = self._get_quota(provider)
                     total_free_mb += quota.get('free_mb', 0.0)
             return total_free_mb
         except Exception as e:
@@ -1,17 +1,20 @@
 import os
 import json
+import base64
+import hashlib
 import logging
-import time
 from datetime import datetime, timedelta
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
+from google.api_core.exceptions import Conflict
 from dotenv import load_dotenv
 import uuid
-import requests
-from storage_providers.google_drive import GoogleDriveProvider
-from storage_providers.dropbox import DropboxProvider
-from tenacity import retry, stop_after_attempt, wait_exponential
+from quota_cache import quota_cache
+from file_cache import file_cache
+from provider_pool import provider_pool
+from token_manager import token_manager
+from tenacity import retry, retry_if_not_exception_type, stop_after_attempt, wait_exponential
 from flask_login import UserMixin
 
 logging.basicConfig(
@@ -81,12 +84,10 @@ class UserRepository:
     def save_user(user: 'User'):
         try:
             doc_ref = db.collection('users').document(user.email)
-            current_data = doc_ref.get().to_dict() if doc_ref.get().exists else {}
             new_data = user.to_dict()
-            if current_data == new_data:
-                logger.debug(f"No changes for user {user.email}, skipping save")
-                return True
-            doc_ref.set(new_data)
+            # storage_used is only ever changed by atomic increments alongside File writes
+            new_data.pop('storage_used', None)
+            doc_ref.set(new_data, merge=True)
             logger.info(f"User {user.email} saved to Firestore")
             return True
         except Exception as e:
@@ -162,75 +163,32 @@ class User(UserMixin):
         return [acc for acc in self.storage_accounts if acc.get('is_active', False)]
 
     def refresh_credentials(self):
-        for account in self.storage_accounts:
-            if not account.get('credentials') or not account.get('is_active', False):
-                continue
-            try:
-                if account['provider_type'] == 'google_drive':
-                    self._refresh_google_drive_token(account)
-                elif account['provider_type'] == 'dropbox':
-                    self._verify_dropbox_token(account)
-            except Exception as e:
-                logger.error(f"Failed to refresh credentials for {account['email']} ({account['provider_type']}): {str(e)}")
-                account['status'] = 'failed'
-                account['error'] = str(e)
-        self.save()
-
-    def _refresh_google_drive_token(self, account):
-        credentials = account['credentials']
-        if not credentials.get('refresh_token'):
-            account['status'] = 'failed'
-            account['error'] = 'No refresh token available'
-            return
-
-        expires_at = credentials.get('expires_at', 0)
-        if expires_at > time.time() + 300:
-            return
-
-        try:
-            response = requests.post(
-                'https://oauth2.googleapis.com/token',
-                data={
-                    'client_id': os.getenv('GOOGLE_CLIENT_ID'),
-                    'client_secret': os.getenv('GOOGLE_CLIENT_SECRET'),
-                    'refresh_token': credentials['refresh_token'],
-                    'grant_type': 'refresh_token'
-                },
-                timeout=10
-            )
-            response.raise_for_status()
-            token_data = response.json()
-            
-            account['credentials'] = {
-                'access_token': token_data['access_token'],
-                'refresh_token': credentials['refresh_token'],
-                'expires_in': token_data['expires_in'],
-                'expires_at': time.time() + token_data['expires_in'] - 60
-            }
-            account['status'] = 'connected'
-            account['is_active'] = True
-            logger.info(f"Refreshed Google Drive token for {account['email']}")
-        except Exception as e:
-            account['status'] = 'failed'
-            account['error'] = str(e)
-            logger.error(f"Google Drive token refresh failed for {account['email']}: {str(e)}")
+        if token_manager.ensure_fresh(self.storage_accounts, self._save_refreshed_credentials):
+            self.save()
+
+    def _save_refreshed_credentials(self, account_id: str, credentials: dict):
+        # Runs on the token manager's background thread; patches only this account in the stored record
+        @firestore.transactional
+        def patch(transaction, doc_ref):
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return False
+            accounts = snapshot.to_dict().get('storage_accounts', [])
+            for account in accounts:
+                if account.get('id') == account_id:
+                    stored = account.get('credentials') or {}
+                    if (stored.get('expires_at') or 0) >= (credentials.get('expires_at') or 0):
+                        return False  # A newer refresh was saved in the meantime
+                    account['credentials'] = credentials
+                    transaction.update(doc_ref, {'storage_accounts': accounts})
+                    return True
+            return False
 
-    def _verify_dropbox_token(self, account):
-        credentials = account['credentials']
         try:
-            provider = DropboxProvider(account['credentials'], f"/MegaCloud/{self.email}")
-            provider.get_storage_quota()
-            account['status'] = 'connected'
-            account['is_active'] = True
-            account['credentials'] = provider.update_credentials()
-            logger.info(f"Verified Dropbox token for {account['email']}")
+            if patch(db.transaction(), db.collection('users').document(self.email)):
+                logger.info(f"Persisted refreshed credentials for storage account {account_id} of {self.email}")
         except Exception as e:
-            account['status'] = 'failed'
-            account['error'] = str(e)
-            logger.error(f"Dropbox token verification failed for {account['email']}: {str(e)}")
-
-    def update_storage_used(self, size_mb: float):
-        self.storage_used = max(0.0, self.storage_used + size_mb)
+            logger.error(f"Failed to persist refreshed credentials for {self.email}: {str(e)}")
 
     def get_storage_accounts_info(self):
         self.update_storage_quota()
@@ -254,20 +212,21 @@ class User(UserMixin):
 
     def update_storage_quota(self):
         self.refresh_credentials()
+        folder_ids = {account['id']: account.get('folder_id') for account in self.storage_accounts}
         for account in self.storage_accounts:
             if account.get('is_active') and account.get('credentials'):
                 try:
-                    if account['provider_type'] == 'google_drive':
-                        provider = GoogleDriveProvider(account['credentials'], f"MegaCloud/{self.email}", self.email)
-                        account['storage_quota'] = provider.get_storage_quota()
-                    elif account['provider_type'] == 'dropbox':
-                        provider = DropboxProvider(account['credentials'], f"/MegaCloud/{self.email}")
-                        account['storage_quota'] = provider.get_storage_quota()
+                    account['storage_quota'] = quota_cache.get(account['id'], lambda account=account: self._fetch_storage_quota(account))
                 except Exception as e:
                     logger.error(f"Quota update failed for {account['email']} ({account['provider_type']}): {str(e)}")
                     account['storage_quota'] = {'total_mb': 0, 'used_mb': 0, 'free_mb': 0}
                     account['status'] = 'failed'
                     account['error'] = str(e)
+        if any(account.get('folder_id') != folder_ids[account['id']] for account in self.storage_accounts):
+            self.save()  # Persist newly resolved Drive folder ids
+
+    def _fetch_storage_quota(self, account):
+        return provider_pool.get(account, self.email).get_storage_quota()
 
     def to_dict(self):
         return {
@@ -288,7 +247,7 @@ class User(UserMixin):
             first_name=data.get('first_name', ''),
             last_name=data.get('last_name', ''),
             username=data.get('username', ''),
-            storage_used=data.get('storage_used', 0.0),
+            storage_used=max(0.0, data.get('storage_used', 0.0)),
             storage_accounts=data.get('storage_accounts', []),
             otp=data.get('otp'),
             otp_expiry=data.get('otp_expiry')
@@ -302,6 +261,17 @@ class File:
         'Audio': ['mp3', 'wav', 'ogg', 'flac'],
         'Other': []
     }
+    # Bumped whenever the per-chunk manifest fields (offset, size, sha256) change shape
+    MANIFEST_VERSION = 1
+    # Listing pages carry only these fields; chunk_ids stay behind for the single-file paths
+    LIST_FIELDS = ['filename', 'size_mb', 'upload_timestamp', 'category', 'user_email']
+    SORT_FIELDS = {
+        'date': ('upload_timestamp', firestore.Query.DESCENDING),
+        'size': ('size_mb', firestore.Query.DESCENDING),
+        'name': ('filename', firestore.Query.ASCENDING)
+    }
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 200
 
     def __init__(self, filename: str, user_email: str, chunk_ids: list, size_mb: float):
         self.id = str(uuid.uuid4())
@@ -309,9 +279,25 @@ class File:
         self.user_email = user_email
         self.chunk_ids = chunk_ids
         self.size_mb = size_mb
+        self.manifest_version = self.MANIFEST_VERSION if File.has_manifest(chunk_ids) else None
+        self.content_hash = File.content_hash_of(chunk_ids)
         self.upload_timestamp = datetime.utcnow().timestamp()
         self.category = self._categorize()
 
+    @staticmethod
+    def has_manifest(chunk_ids: list) -> bool:
+        return bool(chunk_ids) and all(
+            isinstance(chunk, dict) and all(key in chunk for key in ('offset', 'size', 'sha256'))
+            for chunk in chunk_ids
+        )
+
+    @staticmethod
+    def content_hash_of(chunk_ids: list):
+        """Identify a file's bytes by its ordered chunk sha256s, which content-defined chunking makes deterministic."""
+        if not File.has_manifest(chunk_ids):
+            return None
+        return hashlib.sha256(''.join(chunk['sha256'] for chunk in chunk_ids).encode()).hexdigest()
+
     def _categorize(self):
         ext = self.filename.split('.')[-1].lower() if '.' in self.filename else ''
         for category, extensions in self.FILE_CATEGORIES.items():
@@ -319,41 +305,138 @@ class File:
                 return category
         return 'Other'
 
+    @staticmethod
+    def _from_doc(doc) -> dict:
+        data = doc.to_dict()
+        data['id'] = doc.id
+        if 'chunk_ids' in data and isinstance(data['chunk_ids'], list):
+            if not all(isinstance(chunk, dict) for chunk in data['chunk_ids']):
+                logger.warning(f"Converting legacy chunk_ids for file {data['filename']}")
+                data['chunk_ids'] = [
+                    {'chunk_path': chunk} if isinstance(chunk, str) else chunk
+                    for chunk in data['chunk_ids']
+                ]
+        data['manifest_version'] = data.get('manifest_version') or (
+            File.MANIFEST_VERSION if File.has_manifest(data.get('chunk_ids')) else None
+        )
+        data['content_hash'] = data.get('content_hash') or File.content_hash_of(data.get('chunk_ids'))
+        return data
+
+    @staticmethod
+    def _files_version(user_email: str) -> int:
+        """Counter on the user document incremented with every File save and delete, from any process."""
+        snapshot = db.collection('users').document(user_email).get(field_paths=['files_version'])
+        return (snapshot.to_dict() or {}).get('files_version', 0) if snapshot.exists else 0
+
     @staticmethod
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     def get_files(user_email: str):
         try:
+            files_version = File._files_version(user_email)
+            files = file_cache.get(user_email, files_version)
+            if files is not None:
+                return files
+            version = file_cache.version(user_email)
             docs = db.collection('files').where(filter=FieldFilter('user_email', '==', user_email)).stream()
+            files = [File._from_doc(doc) for doc in docs]
+            file_cache.set(user_email, files, version, files_version)
+            logger.info(f"Retrieved {len(files)} files for {user_email}")
+            return files
+        except Exception as e:
+            logger.error(f"Failed to fetch files for {user_email}: {str(e)}", exc_info=True)
+            return None
+
+    @staticmethod
+    def _encode_cursor(data: dict, field: str) -> str:
+        return base64.urlsafe_b64encode(json.dumps([data.get(field), data['id']]).encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> list:
+        try:
+            value, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return [value, doc_id]
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    @staticmethod
+    @retry(retry=retry_if_not_exception_type(ValueError), stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+    def list_files(user_email: str, category: str = None, sort_by: str = 'date', limit: int = None, cursor: str = None):
+        """Return one page of file metadata (without chunk_ids) and the cursor of the next page.
+
+        The cursor is None on the last page. Sorting and category filtering run in Firestore, so
+        a page costs the same however many files the user has. Raises ValueError for a malformed cursor.
+        """
+        start_after = File._decode_cursor(cursor) if cursor else None
+        try:
+            field, direction = File.SORT_FIELDS.get(sort_by, File.SORT_FIELDS['date'])
+            limit = max(1, min(int(limit or File.PAGE_SIZE), File.MAX_PAGE_SIZE))
+            query = db.collection('files').where(filter=FieldFilter('user_email', '==', user_email))
+            if category and category != 'All':
+                query = query.where(filter=FieldFilter('category', '==', category))
+            query = query.select(File.LIST_FIELDS).order_by(field, direction=direction).order_by(
+                firestore.FieldPath.document_id(), direction=direction
+            )
+            if start_after:
+                value, doc_id = start_after
+                query = query.start_after({field: value, firestore.FieldPath.document_id(): doc_id})
+            # One extra document tells us whether another page exists
+            docs = list(query.limit(limit + 1).stream())
             files = []
-            for doc in docs:
+            for doc in docs[:limit]:
                 data = doc.to_dict()
                 data['id'] = doc.id
-                if 'chunk_ids' in data and isinstance(data['chunk_ids'], list):
-                    if not all(isinstance(chunk, dict) for chunk in data['chunk_ids']):
-                        logger.warning(f"Converting legacy chunk_ids for file {data['filename']}")
-                        data['chunk_ids'] = [
-                            {'chunk_path': chunk} if isinstance(chunk, str) else chunk
-                            for chunk in data['chunk_ids']
-                        ]
                 files.append(data)
-            logger.info(f"Retrieved {len(files)} files for {user_email}")
-            return files
+            next_cursor = File._encode_cursor(files[-1], field) if len(docs) > limit else None
+            logger.info(f"Listed {len(files)} files for {user_email} (category={category or 'All'}, sort={sort_by})")
+            return files, next_cursor
         except Exception as e:
-            logger.error(f"Failed to fetch files for {user_email}: {str(e)}", exc_info=True)
+            logger.error(f"Failed to list files for {user_email}: {str(e)}", exc_info=True)
+            return None, None
+
+    @staticmethod
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+    def get_by_id(file_id: str, user_email: str):
+        """Fetch one file record by document id; None if it is missing or belongs to another user."""
+        try:
+            if not file_id:
+                return None
+            # A direct read costs the same as checking the cached listing's version, and is never stale
+            doc = db.collection('files').document(file_id).get()
+            if not doc.exists:
+                return None
+            data = File._from_doc(doc)
+            if data.get('user_email') != user_email:
+                logger.warning(f"File ID {file_id} requested by {user_email} belongs to another user")
+                return None
+            return data
+        except Exception as e:
+            logger.error(f"Failed to fetch file {file_id} for {user_email}: {str(e)}", exc_info=True)
             return None
 
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     def save(self):
+        """Write the record and the owner's usage delta in one batch."""
         try:
             doc_ref = db.collection('files').document(self.id)
-            doc_ref.set({
+            data = {
                 'filename': self.filename,
                 'user_email': self.user_email,
                 'chunk_ids': self.chunk_ids,
                 'size_mb': self.size_mb,
                 'upload_timestamp': self.upload_timestamp,
-                'category': self.category
+                'category': self.category,
+                'manifest_version': self.manifest_version,
+                'content_hash': self.content_hash
+            }
+            # The record and the owner's usage counter change together or not at all
+            batch = db.batch()
+            batch.set(doc_ref, data)
+            batch.update(db.collection('users').document(self.user_email), {
+                'storage_used': firestore.Increment(self.size_mb),
+                'files_version': firestore.Increment(1)
             })
+            batch.commit()
+            file_cache.put_file(self.user_email, dict(data, id=self.id))
             logger.info(f"File {self.filename} saved with ID {self.id}")
             return True
         except Exception as e:
@@ -362,12 +445,118 @@ class File:
 
     @staticmethod
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    def delete_file(file_id: str):
+    def update_manifest(file_id: str, chunk_ids: list, user_email: str = None):
+        """Persist the chunk manifest observed for a legacy record on its first full read."""
+        try:
+            if not File.has_manifest(chunk_ids):
+                raise ValueError("Incomplete chunk manifest")
+            changes = {
+                'chunk_ids': chunk_ids,
+                'manifest_version': File.MANIFEST_VERSION,
+                'content_hash': File.content_hash_of(chunk_ids)
+            }
+            db.collection('files').document(file_id).update(changes)
+            file_cache.update_file(file_id, changes, user_email)
+            logger.info(f"Upgraded chunk manifest for file ID {file_id} to version {File.MANIFEST_VERSION}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to update manifest for file {file_id}: {str(e)}", exc_info=True)
+            return False
+
+    @staticmethod
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+    def delete_file(file_id: str, user_email: str = None, size_mb: float = 0.0):
         try:
             doc_ref = db.collection('files').document(file_id)
-            doc_ref.delete()
+            batch = db.batch()
+            batch.delete(doc_ref)
+            if user_email:
+                batch.update(db.collection('users').document(user_email), {
+                    'storage_used': firestore.Increment(-size_mb),
+                    'files_version': firestore.Increment(1)
+                })
+            batch.commit()
+            file_cache.remove_file(file_id, user_email)
             logger.info(f"File with ID {file_id} deleted from Firestore")
             return True
         except Exception as e:
             logger.error(f"Failed to delete file {file_id}: {str(e)}", exc_info=True)
-            return False
\ No newline at end of file
+            return False
+
+class ChunkIndex:
+    """Per-user index of stored chunks by sha256, with a count of the File records referencing each.
+
+    Identical chunks are stored once; a chunk's provider copy is deleted only when its last
+    reference is released.
+    """
+    FIELDS = ('provider_id', 'chunk_path', 'account_email', 'account_id', 'size', 'sha256')
+
+    @staticmethod
+    def _doc(user_email: str, sha256: str):
+        return db.collection('chunk_index').document(f"{user_email}_{sha256}")
+
+    @staticmethod
+    def acquire(user_email: str, sha256: str):
+        """Take a reference on an already-stored chunk; returns its location, or None if it is not stored."""
+        @firestore.transactional
+        def increment(transaction, doc_ref):
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return None
+            transaction.update(doc_ref, {'refcount': firestore.Increment(1)})
+            return snapshot.to_dict()
+
+        try:
+            entry = increment(db.transaction(), ChunkIndex._doc(user_email, sha256))
+            return {key: entry[key] for key in ChunkIndex.FIELDS if key in entry} if entry else None
+        except Exception as e:
+            logger.error(f"Chunk index lookup failed for {sha256}: {str(e)}", exc_info=True)
+            return None
+
+    @staticmethod
+    def register(user_email: str, chunk_info: dict):
+        """Record a newly uploaded chunk with one reference.
+
+        Returns None on success. If a concurrent upload registered the same content first, a
+        reference on that copy is taken and its location returned; the caller drops its own copy.
+        """
+        entry = {key: chunk_info[key] for key in ChunkIndex.FIELDS}
+        for _ in range(3):
+            try:
+                ChunkIndex._doc(user_email, chunk_info['sha256']).create(dict(entry, refcount=1))
+                return None
+            except Conflict:
+                existing = ChunkIndex.acquire(user_email, chunk_info['sha256'])
+                if existing:
+                    return existing
+                # The other copy was released in between; try to register ours again
+        raise RuntimeError(f"Could not register chunk {chunk_info['sha256']}")
+
+    @staticmethod
+    def release(user_email: str, sha256: str, file_id: str = None, chunk_path: str = None) -> bool:
+        """Drop a reference; returns True when no references remain and the stored copy can be deleted.
+
+        With a file_id the release is recorded on the entry, so a retried delete of the same File
+        never drops a second reference that another File still holds. With a chunk_path, an entry
+        for a different copy of the same content (registered after this one was released) is left alone.
+        """
+        @firestore.transactional
+        def decrement(transaction, doc_ref):
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return True  # Stored before deduplication, or its last reference is already gone
+            entry = snapshot.to_dict()
+            if chunk_path and entry.get('chunk_path') != chunk_path:
+                return True
+            if file_id and file_id in entry.get('released_by', []):
+                return False
+            if entry.get('refcount', 1) <= 1:
+                transaction.delete(doc_ref)
+                return True
+            changes = {'refcount': firestore.Increment(-1)}
+            if file_id:
+                changes['released_by'] = firestore.ArrayUnion([file_id])
+            transaction.update(doc_ref, changes)
+            return False
+
+        return decrement(db.transaction(), ChunkIndex._doc(user_email, sha256))
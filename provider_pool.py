@@ -0,0 +1,87 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from storage_providers.google_drive import GoogleDriveProvider
+from storage_providers.dropbox import DropboxProvider
+
+logger = logging.getLogger(__name__)
+
+class ProviderPool:
+    """Process-wide pool of provider clients keyed by storage account id.
+
+    Building a client costs network round trips (Drive folder lookup, Dropbox account check), so
+    clients are kept between requests. A client is rebuilt when its account's tokens change, and
+    the least recently used clients are dropped once the pool is full or they sit idle too long.
+    """
+
+    def __init__(self, max_size: int = None, idle_ttl: float = None):
+        self.max_size = max_size or int(os.getenv('PROVIDER_POOL_SIZE', 64))
+        self.idle_ttl = idle_ttl if idle_ttl is not None else float(os.getenv('PROVIDER_POOL_IDLE_TTL', 1800))
+        self._clients = OrderedDict()
+        self._folder_ids = {}  # Drive folder ids outlive the clients, which are rebuilt on token refresh
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint(credentials: dict) -> tuple:
+        return (credentials.get('access_token'), credentials.get('refresh_token'))
+
+    def _build(self, account: dict, user_email: str):
+        if account['provider_type'] == 'google_drive':
+            folder_id = account.get('folder_id') or self._folder_ids.get(account['id'])
+            return GoogleDriveProvider(account['credentials'], f"MegaCloud/{user_email}", user_email, folder_id=folder_id)
+        elif account['provider_type'] == 'dropbox':
+            return DropboxProvider(account['credentials'], f"/MegaCloud/{user_email}")
+        raise ValueError(f"Unsupported provider type: {account['provider_type']}")
+
+    def get(self, account: dict, user_email: str):
+        """Return the pooled client for a storage account, building it if missing or if its credentials changed.
+
+        For Drive accounts the resolved folder id is copied onto the account record; callers persist
+        the record when account['folder_id'] changed.
+        """
+        account_id = account['id']
+        fingerprint = self._fingerprint(account['credentials'])
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(account_id)
+            if entry and entry[1] == fingerprint:
+                self._clients[account_id] = (entry[0], fingerprint, now)
+                self._clients.move_to_end(account_id)
+                self._remember_folder(account, entry[0])
+                return entry[0]
+
+        provider = self._build(account, user_email)
+        with self._lock:
+            self._clients[account_id] = (provider, fingerprint, now)
+            self._clients.move_to_end(account_id)
+            while len(self._clients) > self.max_size:
+                evicted_id, _ = self._clients.popitem(last=False)
+                logger.debug(f"Evicted provider client for storage account {evicted_id} (pool full)")
+            self._remember_folder(account, provider)
+        logger.info(f"Built {account['provider_type']} client for storage account {account_id}")
+        return provider
+
+    def _remember_folder(self, account: dict, provider):
+        folder_id = getattr(provider, 'folder_id', None)
+        if folder_id:
+            self._folder_ids[account['id']] = folder_id
+            if account.get('folder_id') != folder_id:
+                account['folder_id'] = folder_id
+
+    def _evict_idle(self, now: float):
+        while self._clients:
+            account_id, (_, _, last_used) = next(iter(self._clients.items()))
+            if now - last_used <= self.idle_ttl:
+                break
+            self._clients.popitem(last=False)
+            logger.debug(f"Evicted idle provider client for storage account {account_id}")
+
+    def evict(self, account_id: str):
+        with self._lock:
+            self._clients.pop(account_id, None)
+            self._folder_ids.pop(account_id, None)
+
+provider_pool = ProviderPool()
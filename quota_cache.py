@@ -0,0 +1,86 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class QuotaCache:
+    """Process-wide snapshot of each storage account's quota, keyed by storage account id.
+
+    Entries older than the TTL are still served while a refresh runs, and uploads/deletes adjust
+    the snapshot locally so the planner and dashboard stay close to the provider's numbers
+    without a round trip per read.
+    """
+
+    def __init__(self, ttl: float = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv('QUOTA_CACHE_TTL', 300))
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, account_id: str, loader, background: bool = True) -> dict:
+        """Return the cached quota for account_id, calling loader() when it is missing or stale.
+
+        With background=True a stale entry is returned immediately and refreshed on a daemon thread;
+        otherwise the refresh happens inline. A loader that reports no total is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(account_id)
+        if entry is None:
+            return self._load(account_id, loader)
+
+        quota, fetched_at = entry
+        if time.time() - fetched_at > self.ttl:
+            if not background:
+                return self._load(account_id, loader)
+            self._refresh_in_background(account_id, loader)
+        return dict(quota)
+
+    def _load(self, account_id: str, loader) -> dict:
+        quota = loader()
+        if quota.get('total_mb', 0) > 0:
+            with self._lock:
+                self._entries[account_id] = (dict(quota), time.time())
+        return dict(quota)
+
+    def _refresh_in_background(self, account_id: str, loader):
+        with self._lock:
+            if account_id in self._refreshing:
+                return
+            self._refreshing.add(account_id)
+
+        def refresh():
+            try:
+                self._load(account_id, loader)
+                logger.debug(f"Refreshed quota snapshot for storage account {account_id}")
+            except Exception as e:
+                logger.error(f"Background quota refresh failed for storage account {account_id}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(account_id)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def debit(self, account_id: str, size_mb: float):
+        """Optimistically account for size_mb written to (or, if negative, removed from) an account."""
+        with self._lock:
+            entry = self._entries.get(account_id)
+            if entry is None:
+                return
+            quota, fetched_at = entry
+            used_mb = max(0.0, quota['used_mb'] + size_mb)
+            self._entries[account_id] = ({
+                'total_mb': quota['total_mb'],
+                'used_mb': used_mb,
+                'free_mb': max(0.0, quota['total_mb'] - used_mb)
+            }, fetched_at)
+
+    def credit(self, account_id: str, size_mb: float):
+        self.debit(account_id, -size_mb)
+
+    def invalidate(self, account_id: str):
+        with self._lock:
+            self._entries.pop(account_id, None)
+
+quota_cache = QuotaCache()
@@ -0,0 +1,161 @@
+import re
+import math
+import logging
+from collections import Counter
+from firebase_admin import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.api_core.exceptions import Conflict
+
+logger = logging.getLogger(__name__)
+
+class SearchIndex:
+    """Per-user inverted index over passages of extracted file content, ranked with BM25.
+
+    Postings live in search_index/{user}/postings, one document per term, file and block of
+    PASSAGES_PER_DOC passages holding parallel arrays of passage numbers, term frequencies and
+    passage lengths. A document therefore never outgrows one block of one file, and a query
+    reads only the documents of its terms. Passage and length totals are counters on
+    search_index/{user}.
+    """
+    VERSION = 3  # Bumped when the postings layout changes; older indexes are rebuilt on first search
+    LEGACY_BUCKETS = 256  # search_index/{user}/buckets/{n} documents written by version 2
+    PASSAGES_PER_DOC = 2000  # Postings per document are bounded by this many passages
+    MAX_TERMS_PER_PASSAGE = 100  # Only the most frequent terms of a passage are indexed
+    MAX_QUERY_TERMS = 30  # Firestore 'in' filters take at most 30 values
+    MAX_BATCH_WRITES = 450  # Firestore batches are capped at 500 writes
+    MAX_BATCH_BYTES = 4 * 1024 * 1024  # and at 10 MiB per request
+    K1 = 1.5
+    B = 0.75
+    STOPWORDS = {
+        'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in', 'is', 'it',
+        'its', 'of', 'on', 'or', 'that', 'the', 'to', 'was', 'were', 'will', 'with', 'this', 'what'
+    }
+
+    def __init__(self, db):
+        self.db = db
+
+    @classmethod
+    def tokenize(cls, text: str) -> list:
+        return [token for token in re.findall(r'[a-z0-9]+', text.lower()) if len(token) > 1 and token not in cls.STOPWORDS]
+
+    @staticmethod
+    def passage_id(file_id: str, passage: int) -> str:
+        return f"{file_id}:{passage}"
+
+    def _user_ref(self, user_email: str):
+        return self.db.collection('search_index').document(user_email)
+
+    def _postings_ref(self, user_email: str):
+        return self._user_ref(user_email).collection('postings')
+
+    def _commit(self, writes):
+        """Apply (op, ref, data, size) writes in batches bounded by count and estimated bytes."""
+        batch, count, size = self.db.batch(), 0, 0
+        for op, ref, data, write_size in writes:
+            if count and (count == self.MAX_BATCH_WRITES or size + write_size > self.MAX_BATCH_BYTES):
+                batch.commit()
+                batch, count, size = self.db.batch(), 0, 0
+            if op == 'set':
+                batch.set(ref, data)
+            else:
+                batch.delete(ref)
+            count += 1
+            size += write_size
+        if count:
+            batch.commit()
+
+    def add(self, user_email: str, file_id: str, passages: list) -> int:
+        """Write the postings of one file's passages and return their total length in tokens.
+
+        The totals are only counted once the caller passes them to record(), so a file whose
+        postings fail part way never skews the statistics.
+        """
+        blocks = {}
+        total_length = 0
+        for passage in passages:
+            tokens = self.tokenize(passage['text'])
+            total_length += len(tokens)
+            block = passage['passage'] // self.PASSAGES_PER_DOC
+            for term, tf in Counter(tokens).most_common(self.MAX_TERMS_PER_PASSAGE):
+                postings = blocks.setdefault((term, block), {'passages': [], 'tf': [], 'lengths': []})
+                postings['passages'].append(passage['passage'])
+                postings['tf'].append(tf)
+                postings['lengths'].append(len(tokens))
+
+        def writes():
+            for (term, block), postings in blocks.items():
+                ref = self._postings_ref(user_email).document(f"{term}:{file_id}:{block}")
+                data = dict(postings, term=term, file_id=file_id)
+                yield 'set', ref, data, 256 + 3 * 9 * len(postings['passages'])
+
+        self._commit(writes())
+        return total_length
+
+    def remove(self, user_email: str, file_id: str):
+        """Delete every posting written for file_id."""
+        query = self._postings_ref(user_email).where(filter=FieldFilter('file_id', '==', file_id)).select([])
+        self._commit(('delete', snapshot.reference, None, 128) for snapshot in query.stream())
+
+    def record(self, batch, user_email: str, passages: int, total_length: int):
+        """Queue a change of the passage and length totals on batch; negative to forget a file.
+
+        A user without totals yet gets them created stamped with VERSION, as everything they will
+        count is in the current layout.
+        """
+        if passages > 0:
+            try:
+                self._user_ref(user_email).create({'version': self.VERSION})
+            except Conflict:
+                pass
+        batch.set(self._user_ref(user_email), {
+            'passages': firestore.Increment(passages),
+            'total_length': firestore.Increment(total_length)
+        }, merge=True)
+
+    def stats(self, user_email: str) -> dict:
+        snapshot = self._user_ref(user_email).get()
+        return snapshot.to_dict() if snapshot.exists else {}
+
+    def clear(self, user_email: str):
+        def writes():
+            for snapshot in self._postings_ref(user_email).select([]).stream():
+                yield 'delete', snapshot.reference, None, 128
+            for bucket in range(self.LEGACY_BUCKETS):
+                yield 'delete', self._user_ref(user_email).collection('buckets').document(str(bucket)), None, 128
+            yield 'delete', self._user_ref(user_email), None, 128
+
+        self._commit(writes())
+
+    def mark_indexed(self, user_email: str, passages: int, total_length: int):
+        """Stamp a rebuilt index with VERSION and the totals counted while rebuilding it."""
+        self._user_ref(user_email).set({
+            'version': self.VERSION,
+            'passages': passages,
+            'total_length': total_length
+        }, merge=True)
+
+    def search(self, user_email: str, terms: list, stats: dict, file_ids=None, limit: int = 10) -> list:
+        """Return [(passage_id, score)] for the best BM25 matches of terms, optionally restricted to file_ids."""
+        terms = list(dict.fromkeys(terms))[:self.MAX_QUERY_TERMS]
+        total_passages = stats.get('passages', 0)
+        if not terms or total_passages <= 0:
+            return []
+        average_length = stats.get('total_length', 0) / total_passages or 1
+        postings = {}
+        query = self._postings_ref(user_email).where(filter=FieldFilter('term', 'in', terms))
+        for snapshot in query.stream():
+            data = snapshot.to_dict()
+            term_postings = postings.setdefault(data['term'], [])
+            for passage, tf, length in zip(data['passages'], data['tf'], data['lengths']):
+                term_postings.append((data['file_id'], passage, tf, length))
+
+        scores = Counter()
+        for term, term_postings in postings.items():
+            # Document frequency counts passages across all files, like the corpus totals
+            idf = math.log(1 + (total_passages - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for file_id, passage, tf, length in term_postings:
+                if file_ids is not None and file_id not in file_ids:
+                    continue
+                norm = self.K1 * (1 - self.B + self.B * length / average_length)
+                scores[self.passage_id(file_id, passage)] += idf * tf * (self.K1 + 1) / (tf + norm)
+        return scores.most_common(limit)
@@ -340,21 +340,31 @@ function loadStats() {
         });
 }
 
-function listFiles(category = 'All') {
+function listFiles(category = 'All', cursor = null) {
     if (!getCsrfToken()) {
         showNotification('CSRF token missing. Please refresh the page.', 'danger');
         return;
     }
-    fetch('/list_files', {
+    const params = new URLSearchParams({ category: category });
+    if (cursor) {
+        params.append('cursor', cursor);
+    }
+    fetch(`/list_files?${params.toString()}`, {
         headers: getFetchHeaders('GET')
     })
         .then(response => response.json())
         .then(data => {
             if (data.success) {
                 const fileList = document.getElementById('fileList');
-                fileList.innerHTML = '';
-                const files = category === 'All' ? data.files : data.categorized[category] || [];
-                if (files.length === 0) {
+                const loadMore = document.getElementById('loadMoreFiles');
+                if (loadMore) {
+                    loadMore.remove();
+                }
+                if (!cursor) {
+                    fileList.innerHTML = '';
+                }
+                const files = data.files;
+                if (files.length === 0 && !cursor) {
                     fileList.innerHTML = '<p class="text-muted">No files found.</p>';
                     return;
                 }
@@ -374,6 +384,14 @@ function listFiles(category = 'All') {
                 `;
                     fileList.appendChild(fileItem);
                 });
+                if (data.next_cursor) {
+                    const button = document.createElement('button');
+                    button.id = 'loadMoreFiles';
+                    button.className = 'btn btn-sm btn-outline-secondary mt-2';
+                    button.textContent = 'Load more';
+                    button.onclick = () => listFiles(category, data.next_cursor);
+                    fileList.appendChild(button);
+                }
                 updateNavLinks(category);
             } else {
                 showNotification(data.error, 'danger');
@@ -633,25 +651,45 @@ function sendAIQuery() {
     chatBody.appendChild(userMessage);
     chatBody.scrollTop = chatBody.scrollHeight;
 
-    fetch('/ai/ask', {
+    const aiMessage = document.createElement('div');
+    aiMessage.className = 'message ai-message';
+    let answer = '';
+
+    fetch('/ai/ask?stream=1', {
         method: 'POST',
         headers: getFetchHeaders('POST', true),
         body: JSON.stringify({ question: query })
     })
     .then(response => {
         console.log('AI query response status:', response.status);
-        return response.json();
-    })
-    .then(data => {
-        if (data.success) {
-            const aiMessage = document.createElement('div');
-            aiMessage.className = 'message ai-message';
-            aiMessage.innerHTML = marked.parse(data.answer);
-            chatBody.appendChild(aiMessage);
-            chatBody.scrollTop = chatBody.scrollHeight;
-        } else {
-            showNotification(data.error, 'danger');
+        if (!response.ok || !response.body) {
+            return response.json().then(data => { throw new Error(data.error || 'AI query failed'); });
+        }
+        chatBody.appendChild(aiMessage);
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        // Render each server-sent event as it arrives so the answer appears while it is generated
+        function read() {
+            return reader.read().then(({ done, value }) => {
+                if (done) return;
+                buffer += decoder.decode(value, { stream: true });
+                const events = buffer.split('\n\n');
+                buffer = events.pop();
+                for (const event of events) {
+                    const type = (event.match(/^event: (.*)$/m) || [])[1] || 'message';
+                    const data = JSON.parse((event.match(/^data: (.*)$/m) || [])[1] || '{}');
+                    if (type === 'error') throw new Error(data.error);
+                    if (type === 'done') return;
+                    answer += data.delta;
+                    aiMessage.innerHTML = marked.parse(answer);
+                    chatBody.scrollTop = chatBody.scrollHeight;
+                }
+                return read();
+            });
         }
+        return read();
     })
     .catch(error => {
         console.error('AI query error:', error);
@@ -1,18 +1,26 @@
 import os
 import logging
 import time
+from datetime import datetime
+import requests
 import dropbox
-from dropbox.exceptions import ApiError, AuthError
+from dropbox.exceptions import ApiError, AuthError, InternalServerError, RateLimitError
+from dropbox.files import CommitInfo, UploadSessionCursor
 from tenacity import retry, stop_after_attempt, wait_fixed
 
 logger = logging.getLogger(__name__)
 
 class DropboxProvider:
     MAX_RETRIES = 3
+    DOWNLOAD_BUFFER_SIZE = 1024 * 1024  # 1MB
+    UPLOAD_PART_SIZE = 8 * 1024 * 1024  # 8MB per upload session request
 
     def __init__(self, credentials: dict, folder_path: str):
         self.access_token = credentials['access_token']
         self.refresh_token = credentials.get('refresh_token')
+        # Without an expiry the SDK refreshes on every new client; token_manager owns refreshes.
+        # The SDK compares against datetime.utcnow(), so this must be naive UTC
+        self.expires_at = datetime.utcfromtimestamp(credentials['expires_at']) if credentials.get('expires_at') else None
         self.folder_path = folder_path
         self.app_key = os.getenv('DROPBOX_APP_KEY')
         self.app_secret = os.getenv('DROPBOX_APP_SECRET')
@@ -24,6 +32,7 @@ class DropboxProvider:
             self.dbx = dropbox.Dropbox(
                 oauth2_access_token=self.access_token,
                 oauth2_refresh_token=self.refresh_token,
+                oauth2_access_token_expiration=self.expires_at,
                 app_key=self.app_key,
                 app_secret=self.app_secret
             )
@@ -36,27 +45,22 @@ class DropboxProvider:
             logger.error(f"Dropbox API error during initialization: {str(e)}", exc_info=True)
             raise
 
-    def update_credentials(self):
-        try:
-            self.dbx.check_and_refresh_access_token()
-            self.access_token = self.dbx._oauth2_access_token
-            return {
-                'access_token': self.access_token,
-                'refresh_token': self.refresh_token,
-                'expires_in': 14400,
-                'expires_at': time.time() + 14400 - 60
-            }
-        except Exception as e:
-            logger.error(f"Failed to refresh Dropbox token: {str(e)}", exc_info=True)
-            raise
+    def upload(self, file_path: str, filename: str) -> str:
+        with open(file_path, 'rb') as f:
+            return self.upload_fileobj(f, filename)
 
     @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
-    def upload(self, file_path: str, filename: str) -> str:
+    def upload_fileobj(self, fileobj, filename: str) -> str:
+        """Upload a seekable file object, in UPLOAD_PART_SIZE parts through an upload session when it is larger than one part."""
         try:
             self.dbx.check_and_refresh_access_token()
             dest_path = f"{self.folder_path}/{filename}"
-            with open(file_path, 'rb') as f:
-                self.dbx.files_upload(f.read(), dest_path, mute=True)
+            size = fileobj.seek(0, os.SEEK_END)
+            fileobj.seek(0)
+            if size <= self.UPLOAD_PART_SIZE:
+                self.dbx.files_upload(fileobj.read(), dest_path, mute=True)
+            else:
+                self._upload_session(fileobj, size, dest_path)
             logger.info(f"Uploaded {filename} to Dropbox at {dest_path}")
             return dest_path
         except ApiError as e:
@@ -67,7 +71,47 @@ class DropboxProvider:
         except Exception as e:
             logger.error(f"Unexpected error uploading {filename}: {str(e)}", exc_info=True)
             raise
-            
+
+    @staticmethod
+    def _correct_offset(error):
+        """Return the offset Dropbox expects next if error reports an offset mismatch, otherwise None."""
+        if hasattr(error, 'is_lookup_failed') and error.is_lookup_failed():
+            error = error.get_lookup_failed()
+        if hasattr(error, 'is_incorrect_offset') and error.is_incorrect_offset():
+            return error.get_incorrect_offset().correct_offset
+        return None
+
+    def _upload_session(self, fileobj, size: int, dest_path: str):
+        session_id = None
+        offset = 0
+        failures = 0
+        while True:
+            fileobj.seek(offset)
+            data = fileobj.read(self.UPLOAD_PART_SIZE)
+            try:
+                if session_id is None:
+                    session_id = self.dbx.files_upload_session_start(data).session_id
+                elif offset + len(data) >= size:
+                    self.dbx.files_upload_session_finish(
+                        data, UploadSessionCursor(session_id=session_id, offset=offset), CommitInfo(path=dest_path, mute=True)
+                    )
+                    return
+                else:
+                    self.dbx.files_upload_session_append_v2(data, UploadSessionCursor(session_id=session_id, offset=offset))
+                offset += len(data)
+                failures = 0
+            except (ApiError, InternalServerError, RateLimitError, requests.exceptions.RequestException) as e:
+                correct_offset = self._correct_offset(e.error) if isinstance(e, ApiError) else None
+                if isinstance(e, ApiError) and correct_offset is None:
+                    raise
+                failures += 1
+                if failures >= self.MAX_RETRIES:
+                    raise
+                if correct_offset is not None:
+                    # The part reached Dropbox before the connection failed; continue from what it acknowledged
+                    offset = correct_offset
+                logger.warning(f"Upload session part at offset {offset} of {dest_path} failed ({str(e)}), resuming (attempt {failures + 1})")
+                time.sleep(2 ** failures)
 
     @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
     def download(self, file_path: str, output_path: str):
@@ -82,6 +126,43 @@ class DropboxProvider:
             logger.error(f"Unexpected error downloading {file_path}: {str(e)}")
             raise
 
+    @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
+    def download_fileobj(self, file_path: str, fileobj, offset: int = 0):
+        try:
+            self.dbx.check_and_refresh_access_token()  # Ensure token is valid
+            # Rewind on every attempt so a retry overwrites the partial write instead of appending to it
+            fileobj.seek(offset)
+            _, response = self.dbx.files_download(file_path)
+            with response:
+                for data in response.iter_content(self.DOWNLOAD_BUFFER_SIZE):
+                    fileobj.write(data)
+            logger.info(f"Downloaded {file_path} at offset {offset}")
+        except ApiError as e:
+            logger.error(f"Failed to download {file_path}: {str(e)}")
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error downloading {file_path}: {str(e)}")
+            raise
+
+    @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
+    def _get_temporary_link(self, file_path: str) -> str:
+        try:
+            self.dbx.check_and_refresh_access_token()  # Ensure token is valid
+            return self.dbx.files_get_temporary_link(file_path).link
+        except ApiError as e:
+            logger.error(f"Failed to get a temporary link for {file_path}: {str(e)}")
+            raise
+
+    def iter_range(self, file_path: str, start: int = 0, end: int = None):
+        """Yield the bytes of a file from start to end (inclusive, None for EOF) as they arrive."""
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+        with requests.get(self._get_temporary_link(file_path), headers=headers, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            for data in response.iter_content(self.DOWNLOAD_BUFFER_SIZE):
+                yield data
+
     @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
     def delete(self, file_path: str):
         try:
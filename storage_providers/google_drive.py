@@ -1,10 +1,12 @@
 import os
+import time
 import logging
+import threading
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-import io
 import requests
 from tenacity import retry, stop_after_attempt, wait_fixed
 
@@ -13,13 +15,25 @@ logger = logging.getLogger(__name__)
 class GoogleDriveProvider:
     SCOPES = ['https://www.googleapis.com/auth/drive']
     MAX_RETRIES = 3
+    RANGE_PART_SIZE = 4 * 1024 * 1024  # 4MB per ranged request
+    UPLOAD_PART_SIZE = 8 * 1024 * 1024  # 8MB per resumable upload request (must be a multiple of 256KB)
+    TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
 
-    def __init__(self, credentials: dict, folder_name: str, user_email: str):
+    def __init__(self, credentials: dict, folder_name: str, user_email: str, folder_id: str = None):
         self.credentials = credentials
         self.folder_name = folder_name
         self.user_email = user_email
-        self.service = self._get_service()
-        self.folder_id = self._get_or_create_folder()
+        # httplib2 connections are not thread-safe, so each thread using this client gets its own service
+        self._local = threading.local()
+        # A folder id resolved earlier is trusted until Drive answers 404 for it
+        self.folder_id = folder_id or self._get_or_create_folder()
+
+    @property
+    def service(self):
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._local.service = self._get_service()
+        return service
 
     def _get_service(self):
         try:
@@ -61,19 +75,62 @@ class GoogleDriveProvider:
             logger.error(f"Failed to get or create folder {self.folder_name}: {str(e)}")
             raise
 
-    @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
-    def upload(self, file_path: str, filename: str) -> str:
+    def _run_upload(self, request) -> dict:
+        """Send a create request, resuming a resumable one from the last byte Drive acknowledged after a transient error."""
+        if not request.resumable:
+            return request.execute()
+        response = None
+        failures = 0
+        while response is None:
+            try:
+                _, response = request.next_chunk()
+                failures = 0
+            except (HttpError, ConnectionError, TimeoutError) as e:
+                if isinstance(e, HttpError) and e.resp.status not in self.TRANSIENT_STATUSES:
+                    raise
+                failures += 1
+                if failures >= self.MAX_RETRIES:
+                    raise
+                # The next call asks Drive how much of the session it has and continues from there
+                logger.warning(f"Upload part failed ({str(e)}), resuming session (attempt {failures + 1})")
+                time.sleep(2 ** failures)
+        return response
+
+    def _create_in_folder(self, filename: str, media):
         try:
-            file_metadata = {
-                'name': filename,
-                'parents': [self.folder_id]
-            }
-            media = MediaFileUpload(file_path)
-            file = self.service.files().create(
-                body=file_metadata,
+            return self._run_upload(self.service.files().create(
+                body={'name': filename, 'parents': [self.folder_id]},
                 media_body=media,
                 fields='id'
-            ).execute()
+            ))
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            logger.warning(f"Folder ID {self.folder_id} for {self.folder_name} no longer exists, looking it up again")
+            self.folder_id = self._get_or_create_folder()
+            return self._run_upload(self.service.files().create(
+                body={'name': filename, 'parents': [self.folder_id]},
+                media_body=media,
+                fields='id'
+            ))
+
+    def upload(self, file_path: str, filename: str) -> str:
+        with open(file_path, 'rb') as f:
+            return self.upload_fileobj(f, filename)
+
+    @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
+    def upload_fileobj(self, fileobj, filename: str) -> str:
+        """Upload a seekable file object, in UPLOAD_PART_SIZE parts through a resumable session when it is larger than one part."""
+        try:
+            size = fileobj.seek(0, os.SEEK_END)
+            fileobj.seek(0)
+            media = MediaIoBaseUpload(
+                fileobj,
+                mimetype='application/octet-stream',
+                chunksize=self.UPLOAD_PART_SIZE,
+                resumable=size > self.UPLOAD_PART_SIZE
+            )
+            file = self._create_in_folder(filename, media)
             file_id = file.get('id')
             logger.info(f"Uploaded {filename} to Google Drive with ID {file_id}")
             return file_id
@@ -95,6 +152,48 @@ class GoogleDriveProvider:
             logger.error(f"Failed to download file ID {file_id}: {str(e)}")
             raise
 
+    @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
+    def download_fileobj(self, file_id: str, fileobj, offset: int = 0):
+        try:
+            # Rewind on every attempt so a retry overwrites the partial write instead of appending to it
+            fileobj.seek(offset)
+            request = self.service.files().get_media(fileId=file_id)
+            downloader = MediaIoBaseDownload(fileobj, request)
+            done = False
+            while not done:
+                status, done = downloader.next_chunk()
+            logger.info(f"Downloaded file ID {file_id} at offset {offset}")
+        except Exception as e:
+            logger.error(f"Failed to download file ID {file_id}: {str(e)}")
+            raise
+
+    @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
+    def _get_media_range(self, file_id: str, first: int, last: int) -> bytes:
+        try:
+            request = self.service.files().get_media(fileId=file_id)
+            request.headers['Range'] = f"bytes={first}-{last}"
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status == 416:  # Range starts past the end of the file
+                return b''
+            logger.error(f"Failed to download bytes {first}-{last} of file ID {file_id}: {str(e)}")
+            raise
+
+    def iter_range(self, file_id: str, start: int = 0, end: int = None):
+        """Yield the bytes of a file from start to end (inclusive, None for EOF) in RANGE_PART_SIZE parts."""
+        position = start
+        while end is None or position <= end:
+            last = position + self.RANGE_PART_SIZE - 1
+            if end is not None:
+                last = min(last, end)
+            data = self._get_media_range(file_id, position, last)
+            if not data:
+                break
+            yield data
+            if len(data) < last - position + 1:
+                break
+            position += len(data)
+
     @retry(stop=stop_after_attempt(MAX_RETRIES), wait=wait_fixed(2))
     def delete(self, file_id: str):
         try:
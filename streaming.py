@@ -0,0 +1,63 @@
+import logging
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, File as FilePart, Data, Epilogue, NeedData
+
+logger = logging.getLogger(__name__)
+
+class MultipartFileStream:
+    """Readable view of one file field of a multipart/form-data body, parsed straight off the wire.
+
+    Werkzeug's regular form parsing spools large uploads to a temp file before the view runs;
+    this reads the request stream incrementally so the caller can forward the bytes elsewhere.
+    """
+    READ_SIZE = 64 * 1024  # 64KB
+
+    def __init__(self, stream, content_type: str, field_name: str = 'file'):
+        mimetype, options = parse_options_header(content_type or '')
+        if mimetype != 'multipart/form-data' or 'boundary' not in options:
+            raise ValueError("Expected a multipart/form-data upload")
+        self.stream = stream
+        self.field_name = field_name
+        self.decoder = MultipartDecoder(options['boundary'].encode('latin-1'))
+        self.filename = None
+        self.buffer = bytearray()
+        self.in_file = False
+        self.finished = False
+        self.eof = False
+        # Advance to the start of the file field so the filename is known up front
+        while self.filename is None and not self.finished:
+            self._pump()
+
+    def _pump(self):
+        if self.eof:
+            self.finished = True
+            return
+        data = self.stream.read(self.READ_SIZE)
+        if not data:
+            self.eof = True
+        self.decoder.receive_data(data or None)
+        event = self.decoder.next_event()
+        while not isinstance(event, NeedData):
+            if isinstance(event, FilePart) and event.name == self.field_name and self.filename is None:
+                self.filename = event.filename
+                self.in_file = True
+            elif isinstance(event, Data) and self.in_file:
+                self.buffer.extend(event.data)
+                if not event.more_data:
+                    self.in_file = False
+                    self.finished = True
+            elif isinstance(event, Epilogue):
+                self.finished = True
+                break
+            event = self.decoder.next_event()
+        if self.eof:
+            self.finished = True
+
+    def read(self, size: int = -1) -> bytes:
+        while (size < 0 or len(self.buffer) < size) and not self.finished:
+            self._pump()
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
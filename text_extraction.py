@@ -0,0 +1,234 @@
+import os
+import sys
+import codecs
+import signal
+import contextlib
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+import magic
+from PyPDF2 import PdfReader
+from docx import Document
+import openpyxl
+from extraction_cache import extraction_cache
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; workers then run without a memory cap
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+SPREADSHEET_ROW_BATCH = 500
+TEXT_READ_SIZE = 1024 * 1024
+
+def _iter_pdf(source):
+    for page in PdfReader(source).pages:
+        page_text = page.extract_text()
+        if page_text:
+            yield page_text + "\n"
+
+def _iter_plain_text(source):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'r', encoding='utf-8', errors='ignore') as f:
+            while True:
+                data = f.read(TEXT_READ_SIZE)
+                if not data:
+                    return
+                yield data
+    else:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        while True:
+            data = source.read(TEXT_READ_SIZE)
+            if not data:
+                yield decoder.decode(b'', final=True)
+                return
+            yield decoder.decode(data)
+
+def _iter_docx(source):
+    for para in Document(source).paragraphs:
+        yield para.text + "\n"
+
+def _iter_spreadsheet(source):
+    # Read-only mode streams rows from the sheet XML instead of building every cell in memory
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        for sheet in wb:
+            rows = []
+            for row in sheet.iter_rows(values_only=True):
+                rows.append(" ".join(str(value) for value in row if value) + "\n")
+                if len(rows) == SPREADSHEET_ROW_BATCH:
+                    yield "".join(rows)
+                    rows = []
+            if rows:
+                yield "".join(rows)
+    finally:
+        wb.close()
+
+def iter_text(source):
+    """Yield the text of a file path or seekable binary file object piece by piece (pages, paragraphs, row batches)."""
+    mime = magic.Magic(mime=True)
+    if isinstance(source, (str, os.PathLike)):
+        file_type = mime.from_file(source)
+    else:
+        file_type = mime.from_buffer(source.read(2048))
+        source.seek(0)
+    if file_type == 'application/pdf':
+        return _iter_pdf(source)
+    if file_type.startswith('text') or file_type in ['application/csv', 'text/csv']:
+        return _iter_plain_text(source)
+    if file_type in ['application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/msword']:
+        return _iter_docx(source)
+    if file_type in ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-excel']:
+        return _iter_spreadsheet(source)
+    return iter(())
+
+def extract_text(source, max_bytes: int = None):
+    """Extract text from a file path or a seekable binary file object, stopping after max_bytes of UTF-8 text."""
+    if max_bytes is None:
+        max_bytes = int(os.getenv('EXTRACTION_MAX_MB', 10)) * 1024 * 1024
+    parts = []
+    remaining = max_bytes
+    try:
+        for part in iter_text(source):
+            size = len(part.encode('utf-8'))
+            if size >= remaining:
+                parts.append(part.encode('utf-8')[:remaining].decode('utf-8', errors='ignore'))
+                logger.info(f"Text extraction for {source} stopped at the {max_bytes} byte budget")
+                break
+            parts.append(part)
+            remaining -= size
+    except MemoryError:
+        raise
+    except TimeoutError:
+        logger.error(f"Text extraction timed out for {source}, keeping the text extracted so far")
+    except Exception as e:
+        # Keep whatever was extracted before the parser failed
+        logger.error(f"Text extraction failed for {source}: {str(e)}")
+    return "".join(parts).strip()
+
+def _limit_memory(memory_limit: int):
+    if resource and memory_limit:
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        except (ValueError, OSError) as e:
+            logger.warning(f"Could not cap extraction worker memory: {str(e)}")
+
+def _alarm(signum, frame):
+    raise TimeoutError("Text extraction timed out")
+
+def _extract_with_timeout(path: str, timeout: int) -> str:
+    # Runs in a worker process; the alarm interrupts parsers stuck on a pathological file
+    signal.signal(signal.SIGALRM, _alarm)
+    signal.alarm(timeout)
+    try:
+        return extract_text(path)
+    finally:
+        signal.alarm(0)
+
+@contextlib.contextmanager
+def _as_main():
+    # A spawned worker imports the parent's __main__ before anything else; with bot.py or app.py
+    # that repeats their Firestore and AI setup inside the worker's memory cap
+    main = sys.modules.get('__main__')
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+class TextExtractor:
+    """Runs text extraction in a pool of worker processes, each capped in memory and time per file.
+
+    Workers are spawned rather than forked so they never inherit the Firestore/gRPC state of the
+    web or bot process, and they start from this module rather than the parent's entry script.
+    submit() returns immediately; the extracted text is handed to a callback on a background
+    thread once the worker finishes.
+    """
+
+    def __init__(self, max_workers: int = None, timeout: int = None, memory_mb: int = None):
+        self.max_workers = max_workers or int(os.getenv('EXTRACTION_WORKERS', 2))
+        self.timeout = timeout or int(os.getenv('EXTRACTION_TIMEOUT', 60))
+        self.memory_limit = (memory_mb or int(os.getenv('EXTRACTION_MEMORY_MB', 1024))) * 1024 * 1024
+        self._processes = None
+        self._threads = ThreadPoolExecutor(max_workers=self.max_workers * 2, thread_name_prefix='extraction')
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_limit_memory,
+                    initargs=(self.memory_limit,)
+                )
+            return self._processes
+
+    def _reset_pool(self, pool: ProcessPoolExecutor):
+        """Replace pool, killing its workers; shutdown() alone leaves a busy worker running."""
+        with self._lock:
+            if self._processes is pool:
+                self._processes = None
+        for process in list((pool._processes or {}).values()):
+            if process.is_alive():
+                process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def extract(self, path: str, content_hash: str = None) -> str:
+        """Extract the text of the file at path in a worker; returns '' if it fails, times out or runs out of memory.
+
+        With a content_hash, text already extracted from the same bytes is reused and a fresh
+        extraction is cached for the next caller.
+        """
+        text = extraction_cache.get_text(content_hash)
+        if text is not None:
+            logger.debug(f"Reusing extracted text for {path} ({content_hash})")
+            return text
+        pool = self._pool()
+        future = None
+        try:
+            # The pool starts workers on demand inside submit()
+            with self._lock, _as_main():
+                future = pool.submit(_extract_with_timeout, path, self.timeout)
+            # The worker's alarm fires first; the extra wait only covers a worker that never answers
+            text = future.result(timeout=self.timeout + 30)
+            extraction_cache.put(content_hash, text)
+            return text
+        except (TimeoutError, FutureTimeout):
+            logger.error(f"Text extraction timed out after {self.timeout}s for {path}")
+            if future is not None and not future.done():
+                # The worker ignored its alarm (stuck in C code, or the parser swallowed the
+                # TimeoutError) and would hold its slot forever; other files in flight are lost too
+                self._reset_pool(pool)
+        except MemoryError:
+            logger.error(f"Text extraction ran out of memory ({self.memory_limit // (1024 * 1024)} MB) for {path}")
+        except BrokenProcessPool as e:
+            # A worker killed outright (e.g. by the OOM killer) breaks the whole pool
+            logger.error(f"Text extraction worker died for {path}: {str(e)}")
+            self._reset_pool(pool)
+        except Exception as e:
+            logger.error(f"Text extraction failed for {path}: {str(e)}")
+        return ''
+
+    def submit(self, path: str, on_text, cleanup: bool = False, content_hash: str = None):
+        """Extract path in the background and call on_text(text) with the result; deletes path afterwards if cleanup."""
+        def run():
+            try:
+                text = self.extract(path, content_hash)
+                if text:
+                    on_text(text)
+            except Exception as e:
+                logger.error(f"Background extraction of {path} failed: {str(e)}")
+            finally:
+                if cleanup and os.path.exists(path):
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        logger.error(f"Cleanup failed for {path}: {str(e)}")
+
+        return self._threads.submit(run)
+
+text_extractor = TextExtractor()
@@ -0,0 +1,149 @@
+import os
+import time
+import logging
+import threading
+import requests
+
+logger = logging.getLogger(__name__)
+
+class TokenManager:
+    """Refreshes storage account access tokens based on their expires_at, keyed by storage account id.
+
+    Tokens inside the safety window are refreshed inline; tokens inside the prefetch window are
+    refreshed on a daemon thread so requests never wait on them. Concurrent refreshes of the same
+    account are coalesced, and the latest tokens are shared with every copy of the account in
+    the process.
+    """
+    GOOGLE_TOKEN_URL = 'https://oauth2.googleapis.com/token'
+    DROPBOX_TOKEN_URL = 'https://api.dropboxapi.com/oauth2/token'
+
+    def __init__(self, safety_window: float = None, prefetch_window: float = None):
+        self.safety_window = safety_window if safety_window is not None else float(os.getenv('TOKEN_REFRESH_WINDOW', 300))
+        self.prefetch_window = prefetch_window if prefetch_window is not None else float(os.getenv('TOKEN_PREFETCH_WINDOW', 900))
+        self._tokens = {}  # account id -> most recent credentials seen in this process
+        self._locks = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _account_lock(self, account_id: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(account_id, threading.Lock())
+
+    @staticmethod
+    def _expires_at(credentials: dict) -> float:
+        if credentials.get('expires_at') is None and not credentials.get('refresh_token'):
+            return float('inf')  # Long-lived token, nothing to refresh
+        return credentials.get('expires_at') or 0
+
+    def _adopt(self, account: dict) -> bool:
+        """Swap in newer tokens refreshed elsewhere in the process; returns True if the account changed."""
+        with self._lock:
+            known = self._tokens.get(account['id'])
+        if known and self._expires_at(known) > self._expires_at(account['credentials']):
+            account['credentials'] = dict(known)
+            return True
+        return False
+
+    def ensure_fresh(self, accounts: list, persist=None) -> bool:
+        """Make sure every active account in accounts holds a usable access token.
+
+        Returns True when an account was modified inline and should be saved. persist(account_id,
+        credentials) is called from the background thread after a prefetch refresh.
+        """
+        changed = False
+        for account in accounts:
+            if not account.get('credentials') or not account.get('is_active', False):
+                continue
+            changed |= self._adopt(account)
+            remaining = self._expires_at(account['credentials']) - time.time()
+            if remaining <= self.safety_window:
+                changed |= self._refresh(account)
+            elif remaining <= self.prefetch_window:
+                self._refresh_in_background(account, persist)
+        return changed
+
+    def _refresh(self, account: dict) -> bool:
+        with self._account_lock(account['id']):
+            # Another thread may have refreshed this account while we waited for the lock
+            adopted = self._adopt(account)
+            if self._expires_at(account['credentials']) - time.time() > self.safety_window:
+                return adopted
+
+            before = (account.get('status'), account.get('error'))
+            try:
+                credentials = self._request_token(account)
+                with self._lock:
+                    self._tokens[account['id']] = credentials
+                account['credentials'] = dict(credentials)
+                account['status'] = 'connected'
+                account['is_active'] = True
+                logger.info(f"Refreshed {account['provider_type']} token for {account['email']}")
+                return True
+            except Exception as e:
+                logger.error(f"Token refresh failed for {account['email']} ({account['provider_type']}): {str(e)}")
+                account['status'] = 'failed'
+                account['error'] = str(e)
+                return adopted or before != (account['status'], account['error'])
+
+    def _refresh_in_background(self, account: dict, persist):
+        with self._lock:
+            if account['id'] in self._refreshing:
+                return
+            self._refreshing.add(account['id'])
+        snapshot = dict(account, credentials=dict(account['credentials']))
+
+        def refresh():
+            try:
+                with self._account_lock(snapshot['id']):
+                    if self._adopt(snapshot):
+                        return  # Refreshed inline by another request in the meantime
+                    credentials = self._request_token(snapshot)
+                    with self._lock:
+                        self._tokens[snapshot['id']] = credentials
+                logger.info(f"Refreshed {snapshot['provider_type']} token for {snapshot['email']} ahead of expiry")
+                if persist:
+                    persist(snapshot['id'], dict(credentials))
+            except Exception as e:
+                # The inline refresh inside the safety window will retry and record the failure
+                logger.error(f"Background token refresh failed for {snapshot['email']} ({snapshot['provider_type']}): {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(snapshot['id'])
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _request_token(self, account: dict) -> dict:
+        credentials = account['credentials']
+        if not credentials.get('refresh_token'):
+            raise ValueError('No refresh token available')
+
+        if account['provider_type'] == 'google_drive':
+            url = self.GOOGLE_TOKEN_URL
+            client_id, client_secret = os.getenv('GOOGLE_CLIENT_ID'), os.getenv('GOOGLE_CLIENT_SECRET')
+        elif account['provider_type'] == 'dropbox':
+            url = self.DROPBOX_TOKEN_URL
+            client_id, client_secret = os.getenv('DROPBOX_APP_KEY'), os.getenv('DROPBOX_APP_SECRET')
+        else:
+            raise ValueError(f"Unsupported provider type: {account['provider_type']}")
+
+        response = requests.post(
+            url,
+            data={
+                'client_id': client_id,
+                'client_secret': client_secret,
+                'refresh_token': credentials['refresh_token'],
+                'grant_type': 'refresh_token'
+            },
+            timeout=10
+        )
+        response.raise_for_status()
+        token_data = response.json()
+        expires_in = token_data.get('expires_in', 14400)
+        return {
+            'access_token': token_data['access_token'],
+            'refresh_token': token_data.get('refresh_token', credentials['refresh_token']),
+            'expires_in': expires_in,
+            'expires_at': time.time() + expires_in - 60
+        }
+
+token_manager = TokenManager()
@@ -0,0 +1,152 @@
+import os
+import hashlib
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; the store directory is then not locked
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+class VectorStore:
+    """Passage embeddings for each user's file content in chromadb.
+
+    With CHROMA_HOST set, every process shares that chromadb server; this is the supported setup
+    for several gunicorn workers or the web app and bot on one host. Otherwise the store is a
+    local PersistentClient directory, which chromadb does not support across processes, so the
+    first process to lock it owns it and the others run without vectors.
+
+    chromadb and sentence-transformers are imported on first use; when either is missing, or the
+    directory is owned elsewhere, the store reports itself unavailable and callers fall back to
+    keyword search.
+    """
+    EMBED_BATCH_SIZE = 32
+
+    def __init__(self, path: str = None, model_name: str = None):
+        self.path = os.path.abspath(path or os.getenv('VECTOR_STORE_PATH', 'vector_store'))
+        self.host = os.getenv('CHROMA_HOST')
+        self.port = int(os.getenv('CHROMA_PORT', 8000))
+        self.model_name = model_name or os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+        self._client = None
+        self._model = None
+        self._available = None
+        self._owner_lock = None
+        self._file_ids = {}  # user -> ids of embedded files, read from chromadb on first use
+        self._lock = threading.Lock()
+
+    def _load(self) -> bool:
+        with self._lock:
+            if self._available is None:
+                try:
+                    import chromadb
+                    from sentence_transformers import SentenceTransformer
+                    if self.host:
+                        self._client = chromadb.HttpClient(host=self.host, port=self.port)
+                    else:
+                        self._claim_path()
+                        self._client = chromadb.PersistentClient(path=self.path)
+                    self._model = SentenceTransformer(self.model_name)
+                    self._available = True
+                    logger.info(f"Vector store ready at {self.host or self.path} with {self.model_name}")
+                except Exception as e:
+                    self._available = False
+                    logger.warning(f"Vector store unavailable, using keyword search only: {str(e)}")
+            return self._available
+
+    def _claim_path(self):
+        # Held for the life of the process; a second gunicorn worker or the bot gets an error here
+        os.makedirs(self.path, exist_ok=True)
+        handle = open(os.path.join(self.path, '.owner.lock'), 'w')
+        if fcntl:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                raise RuntimeError(f"{self.path} is in use by another process; set CHROMA_HOST to share a chromadb server")
+        self._owner_lock = handle
+
+    @property
+    def available(self) -> bool:
+        return self._load()
+
+    def _collection(self, user_email: str):
+        # Collection names are limited to 63 alphanumeric characters, so users are addressed by hash
+        name = f"user_{hashlib.sha1(user_email.encode('utf-8')).hexdigest()}"
+        return self._client.get_or_create_collection(name=name, metadata={'hnsw:space': 'cosine'})
+
+    def _embed(self, texts: list) -> list:
+        return self._model.encode(texts, batch_size=self.EMBED_BATCH_SIZE, normalize_embeddings=True).tolist()
+
+    def file_ids(self, user_email: str, refresh: bool = False) -> set:
+        """Ids of the files whose passages are embedded for user_email."""
+        if not self._load():
+            return set()
+        with self._lock:
+            known = None if refresh else self._file_ids.get(user_email)
+        if known is None:
+            # Every file has a passage 0, and add() writes it last
+            response = self._collection(user_email).get(where={'passage': 0}, include=['metadatas'])
+            known = {metadata['file_id'] for metadata in response['metadatas']}
+            with self._lock:
+                self._file_ids[user_email] = known
+        return set(known)
+
+    def add(self, user_email: str, file_id: str, filename: str, passages: list):
+        """Embed a file's passages; ids follow the passage numbers stored in Firestore."""
+        if not self._load() or not passages:
+            return
+        collection = self._collection(user_email)
+        # Last batch first, so passage 0 only lands once the rest of the file is embedded
+        for first in reversed(range(0, len(passages), self.EMBED_BATCH_SIZE)):
+            batch = passages[first:first + self.EMBED_BATCH_SIZE]
+            collection.upsert(
+                ids=[f"{file_id}:{passage['passage']}" for passage in batch],
+                embeddings=self._embed([passage['text'] for passage in batch]),
+                documents=[passage['text'] for passage in batch],
+                metadatas=[
+                    {'file_id': file_id, 'filename': filename, 'passage': passage['passage'],
+                     'start': passage['start'], 'end': passage['end']}
+                    for passage in batch
+                ]
+            )
+        with self._lock:
+            if user_email in self._file_ids:
+                self._file_ids[user_email].add(file_id)
+        logger.info(f"Embedded {len(passages)} passages of {filename} for {user_email}")
+
+    def delete(self, user_email: str, file_id: str):
+        if not self._load():
+            return
+        self._collection(user_email).delete(where={'file_id': file_id})
+        with self._lock:
+            self._file_ids.get(user_email, set()).discard(file_id)
+
+    def query(self, user_email: str, query: str, file_ids=None, k: int = 8) -> list:
+        """Return the k passages nearest to query as dicts with file_id, filename, text, start, end and score."""
+        if not self._load():
+            return []
+        collection = self._collection(user_email)
+        if not collection.count():
+            return []
+        where = {'file_id': {'$in': list(file_ids)}} if file_ids else None
+        response = collection.query(
+            query_embeddings=self._embed([query]),
+            n_results=min(k, collection.count()),
+            where=where
+        )
+        passages = []
+        for text, metadata, distance in zip(response['documents'][0], response['metadatas'][0], response['distances'][0]):
+            passages.append({
+                'file_id': metadata['file_id'],
+                'filename': metadata['filename'],
+                'passage': metadata['passage'],
+                'text': text,
+                'start': metadata['start'],
+                'end': metadata['end'],
+                'score': 1 - distance
+            })
+        return passages
+
+vector_store = VectorStore()